@@ -24,6 +24,10 @@ def create_app(config_name=None):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     
+    # Timezone risolta una volta sola, a config caricata
+    from utils import freeze_timezone
+    freeze_timezone(app)
+    
     # Inizializza estensioni
     from models import db
     db.init_app(app)
@@ -87,6 +91,9 @@ def create_app(config_name=None):
     # Crea tabelle database
     with app.app_context():
         db.create_all()
+        # Indici aggiunti dopo la creazione delle tabelle (es. ix_error_active)
+        from models import create_missing_indexes
+        create_missing_indexes(db.engine)
         logger.info("Database inizializzato")
     
     # Inizializza scheduler (solo se non in testing)
@@ -33,6 +33,9 @@ class Config:
     # Logging
     LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
     
+    # Log esecuzioni: quanti QueryLog accumulare prima di scriverli in blocco
+    QUERY_LOG_BATCH_SIZE = int(os.environ.get('QUERY_LOG_BATCH_SIZE') or 10)
+    
     # Log retention (giorni)
     LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS') or 30)
     
@@ -44,6 +47,9 @@ class Config:
     
     # Timezone per visualizzazione date (default: UTC)
     TIMEZONE = os.environ.get('TIMEZONE', 'UTC')
+    # true se TIMEZONE cambia tra richieste (override di config/env):
+    # la timezone non viene fissata all'avvio (vedi utils.freeze_timezone)
+    TIMEZONE_PER_REQUEST = os.environ.get('TIMEZONE_PER_REQUEST', 'false').lower() == 'true'
 
     # Babel i18n
     BABEL_DEFAULT_LOCALE = 'en'
@@ -89,6 +95,9 @@ class TestingConfig(Config):
     MAIL_PASSWORD = 'test'
     MAIL_DEFAULT_SENDER = 'test@test.com'
     
+    # Log esecuzioni scritti subito
+    QUERY_LOG_BATCH_SIZE = 1
+    
     # Retention breve per test
     LOG_RETENTION_DAYS = 1
     EMAIL_LOG_RETENTION_DAYS = 1
@@ -10,6 +10,21 @@ import json
 db = SQLAlchemy()
 
 
+def create_missing_indexes(engine):
+    """
+    Crea gli indici dei modelli mancanti nel database.
+    db.create_all() non aggiunge indici a tabelle già esistenti e non ci
+    sono migrazioni: i database creati prima di un nuovo indice (es.
+    ix_error_active) lo ricevono da qui all'avvio.
+    
+    Args:
+        engine: engine SQLAlchemy del database di appoggio
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 class MonitoredQuery(db.Model):
     """
     Definizione delle consultazioni da monitorare.
@@ -454,13 +469,28 @@ class ErrorRecord(db.Model):
     occurrence_count = db.Column(db.Integer, default=1)
     
     # Indice composto per ricerche efficienti
+    # Indice parziale sui soli errori attivi (filtro resolved_at IS NULL)
     __table_args__ = (
         db.Index('ix_error_query_hash', 'query_id', 'error_hash'),
+        db.Index('ix_error_active', 'query_id',
+                 sqlite_where=db.text('resolved_at IS NULL'),
+                 postgresql_where=db.text('resolved_at IS NULL')),
     )
     
     def get_error_data(self):
-        """Deserializza i dati dell'errore"""
-        return json.loads(self.error_data) if self.error_data else {}
+        """
+        Deserializza i dati dell'errore.
+        La decodifica è memorizzata sull'istanza finché error_data non cambia;
+        ogni chiamata restituisce una copia (shallow), modificabile senza
+        effetti sulle letture successive.
+        """
+        if not self.error_data:
+            return {}
+        cached = getattr(self, '_error_data_cache', None)
+        if cached is None or cached[0] is not self.error_data:
+            cached = (self.error_data, json.loads(self.error_data))
+            self._error_data_cache = cached
+        return dict(cached[1])
     
     def set_error_data(self, data):
         """Serializza i dati dell'errore"""
@@ -485,6 +515,24 @@ class ErrorRecord(db.Model):
         elapsed_minutes = (get_utc_now() - last_notification).total_seconds() / 60
         return elapsed_minutes >= query.reminder_interval_minutes
     
+    @classmethod
+    def due_for_reminder(cls, query, now=None):
+        """
+        Query degli errori attivi che necessitano un reminder.
+        Stesso criterio di needs_reminder, valutato direttamente in SQL.
+        """
+        if now is None:
+            now = get_utc_now()
+        cutoff = now - timedelta(minutes=query.reminder_interval_minutes)
+        
+        return cls.query.filter(
+            cls.query_id == query.id,
+            cls.resolved_at == None,
+            cls.email_sent == True,
+            cls.reminder_count < query.reminder_max_count,
+            db.func.coalesce(cls.last_reminder_at, cls.email_sent_at) <= cutoff
+        )
+    
     @staticmethod
     def calculate_hash(data: dict, key_fields: list) -> str:
         """Calcola l'hash univoco dell'errore basato sui campi chiave."""
@@ -501,6 +549,21 @@ class ErrorRecord(db.Model):
         hash_string = '|'.join(key_values)
         return hashlib.sha256(hash_string.encode()).hexdigest()
     
+    @classmethod
+    def active_error_count(cls, query_id: int, cap: int = None) -> int:
+        """
+        Conta gli errori attivi di una query.
+        Con cap il conteggio si ferma a cap righe (COUNT su subquery con LIMIT),
+        utile quando basta sapere se gli errori sono almeno/al più N.
+        """
+        active = db.session.query(cls.id).filter(
+            cls.query_id == query_id,
+            cls.resolved_at == None
+        )
+        if cap is not None:
+            active = active.limit(cap)
+        return db.session.query(db.func.count()).select_from(active.subquery()).scalar()
+    
     def __repr__(self):
         return f'<ErrorRecord {self.error_hash[:8]}... query={self.query_id}>'
 
@@ -2,11 +2,12 @@
 Servizio principale di monitoraggio.
 Gestisce l'esecuzione periodica delle query, routing condizionale e reminder.
 """
+import atexit
 import logging
 from datetime import datetime, timedelta
 from utils import get_utc_now
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from models import db, MonitoredQuery, ErrorRecord, QueryLog
 from data_sources import execute_query_source, test_query_source, get_query_fields
 from routing_service import apply_routing_rules, get_routing_summary
@@ -15,6 +16,14 @@ from email_service import email_service
 logger = logging.getLogger(__name__)
 
 
+# Massimo di log di esecuzione in coda (in caso di errori di scrittura ripetuti)
+MAX_PENDING_LOGS = 1000
+
+# Tentativi di scrittura di un log prima di scartarlo (es. violazione di FK
+# per una query eliminata prima del flush)
+MAX_LOG_FLUSH_ATTEMPTS = 3
+
+
 class MonitorService:
     """
     Orchestrazione del monitoraggio errori.
@@ -23,11 +32,22 @@ class MonitorService:
     
     def __init__(self, app=None):
         self.app = app
+        self.log_batch_size = 1
+        # Coda di (log, tentativi falliti). Limitata: se il DB resta
+        # irraggiungibile si perdono i log più vecchi
+        self._pending_logs = deque(maxlen=MAX_PENDING_LOGS)
+        self._exit_flush_registered = False
         
     def init_app(self, app):
         """Inizializza l'estensione Flask."""
         self.app = app
+        self.log_batch_size = max(1, app.config.get('QUERY_LOG_BATCH_SIZE', 1))
         app.extensions['monitor'] = self
+        
+        # Scrive i log ancora in coda allo shutdown del processo
+        if not self._exit_flush_registered:
+            atexit.register(self._flush_logs_at_exit)
+            self._exit_flush_registered = True
     
     def check_query(self, query: MonitoredQuery, force: bool = False) -> dict:
         """
@@ -102,78 +122,14 @@ class MonitorService:
             columns, rows = execute_query_source(query)
             result['rows_returned'] = len(rows)
             
-            # 3. Ottieni i campi chiave
-            key_fields = query.get_key_fields_list()
-            
-            # 4. Calcola gli hash degli errori attuali
-            current_errors = {}
-            for row in rows:
-                error_hash = ErrorRecord.calculate_hash(row, key_fields)
-                current_errors[error_hash] = row
-            
-            # 5. Recupera errori esistenti non risolti
-            existing_errors = {
-                e.error_hash: e 
-                for e in ErrorRecord.query.filter_by(
-                    query_id=query.id, 
-                    resolved_at=None
-                ).all()
-            }
-            
-            # 6. Trova nuovi, risolti, continuano
-            new_error_hashes = set(current_errors.keys()) - set(existing_errors.keys())
-            resolved_hashes = set(existing_errors.keys()) - set(current_errors.keys())
-            continuing_hashes = set(current_errors.keys()) & set(existing_errors.keys())
-            
-            # 7. Gestisci nuovi errori
-            new_errors_data = []
-            for hash_val in new_error_hashes:
-                error_data = current_errors[hash_val]
-                new_record = ErrorRecord(
-                    query_id=query.id,
-                    error_hash=hash_val,
-                    email_sent=False
-                )
-                new_record.set_error_data(error_data)
-                db.session.add(new_record)
-                new_errors_data.append(error_data)
-                result['new_errors'] += 1
-            
-            # 8. Marca errori risolti
-            for hash_val in resolved_hashes:
-                error = existing_errors[hash_val]
-                error.resolved_at = get_utc_now()
-                result['resolved_errors'] += 1
-            
-            # 9. Aggiorna errori esistenti ancora presenti
-            for hash_val in continuing_hashes:
-                error = existing_errors[hash_val]
-                error.last_seen_at = get_utc_now()
-                error.occurrence_count += 1
-            
-            # Commit parziale per avere gli ID
-            db.session.flush()
-            
-            # 10. Invia notifiche per nuovi errori
-            if new_errors_data:
-                emails_sent = self._send_notifications(
-                    query, new_errors_data, columns, email_type='new_errors'
-                )
-                result['emails_sent'] += emails_sent
-                
-                # Marca errori come notificati
-                if emails_sent > 0:
-                    for hash_val in new_error_hashes:
-                        new_error = ErrorRecord.query.filter_by(
-                            query_id=query.id,
-                            error_hash=hash_val
-                        ).first()
-                        if new_error:
-                            new_error.email_sent = True
-                            new_error.email_sent_at = get_utc_now()
+            if not rows:
+                # Nessuna riga: niente da deduplicare, risolvi in blocco gli attivi
+                result['resolved_errors'] = self._resolve_all_active(query)
+            else:
+                self._process_rows(query, columns, rows, result)
             
             # 11. Gestisci reminder per errori non risolti
-            if query.reminder_enabled:
+            if rows and query.reminder_enabled:
                 reminders_sent = self._process_reminders(query, columns)
                 result['reminders_sent'] = reminders_sent
                 result['emails_sent'] += reminders_sent
@@ -201,8 +157,11 @@ class MonitorService:
             except:
                 pass
         
-        # 13. Log dell'esecuzione
+        # 13. Log dell'esecuzione (subito per le esecuzioni manuali,
+        # così stato e pagine dei log sono aggiornati)
         self._log_execution(query, result, start_time)
+        if force:
+            self.flush_logs()
         
         logger.info(
             f"Query {query.name} completata: "
@@ -214,6 +173,93 @@ class MonitorService:
         
         return result
     
+    def _process_rows(self, query: MonitoredQuery, columns: list, rows: list, result: dict):
+        """
+        Confronta le righe restituite con gli errori attivi: inserisce i nuovi,
+        risolve quelli scomparsi e notifica. Aggiorna result in place.
+        """
+        # 3. Ottieni i campi chiave
+        key_fields = query.get_key_fields_list()
+        
+        # 4. Calcola gli hash degli errori attuali
+        current_errors = {}
+        for row in rows:
+            error_hash = ErrorRecord.calculate_hash(row, key_fields)
+            current_errors[error_hash] = row
+        
+        # 5. Recupera errori esistenti non risolti
+        existing_errors = {
+            e.error_hash: e 
+            for e in ErrorRecord.query.filter_by(
+                query_id=query.id, 
+                resolved_at=None
+            ).all()
+        }
+        
+        # 6. Trova nuovi, risolti, continuano
+        new_error_hashes = set(current_errors.keys()) - set(existing_errors.keys())
+        resolved_hashes = set(existing_errors.keys()) - set(current_errors.keys())
+        continuing_hashes = set(current_errors.keys()) & set(existing_errors.keys())
+        
+        # 7. Gestisci nuovi errori
+        new_errors_data = []
+        for hash_val in new_error_hashes:
+            error_data = current_errors[hash_val]
+            new_record = ErrorRecord(
+                query_id=query.id,
+                error_hash=hash_val,
+                email_sent=False
+            )
+            new_record.set_error_data(error_data)
+            db.session.add(new_record)
+            new_errors_data.append(error_data)
+            result['new_errors'] += 1
+        
+        # 8. Marca errori risolti
+        for hash_val in resolved_hashes:
+            error = existing_errors[hash_val]
+            error.resolved_at = get_utc_now()
+            result['resolved_errors'] += 1
+        
+        # 9. Aggiorna errori esistenti ancora presenti
+        for hash_val in continuing_hashes:
+            error = existing_errors[hash_val]
+            error.last_seen_at = get_utc_now()
+            error.occurrence_count += 1
+        
+        # Commit parziale per avere gli ID
+        db.session.flush()
+        
+        # 10. Invia notifiche per nuovi errori
+        if new_errors_data:
+            emails_sent = self._send_notifications(
+                query, new_errors_data, columns, email_type='new_errors'
+            )
+            result['emails_sent'] += emails_sent
+        
+            # Marca errori come notificati
+            if emails_sent > 0:
+                for hash_val in new_error_hashes:
+                    new_error = ErrorRecord.query.filter_by(
+                        query_id=query.id,
+                        error_hash=hash_val
+                    ).first()
+                    if new_error:
+                        new_error.email_sent = True
+                        new_error.email_sent_at = get_utc_now()
+
+    def _resolve_all_active(self, query: MonitoredQuery) -> int:
+        """
+        Marca come risolti tutti gli errori attivi della query con un solo UPDATE.
+        
+        Returns:
+            int: Numero di errori risolti
+        """
+        return ErrorRecord.query.filter_by(
+            query_id=query.id,
+            resolved_at=None
+        ).update({ErrorRecord.resolved_at: get_utc_now()})
+    
     def _send_notifications(self, query: MonitoredQuery, errors: list, 
                            columns: list, email_type: str = 'new_errors') -> int:
         """
@@ -287,58 +333,130 @@ class MonitorService:
         Returns:
             int: Numero di reminder inviati
         """
-        # Trova errori che necessitano reminder
-        errors_needing_reminder = []
-        error_records = []
+        # Trova errori che necessitano reminder (filtro in SQL)
+        error_records = ErrorRecord.due_for_reminder(query).all()
         
-        for error in ErrorRecord.query.filter_by(
-            query_id=query.id,
-            resolved_at=None,
-            email_sent=True
-        ).all():
-            if error.needs_reminder(query):
-                errors_needing_reminder.append(error.get_error_data())
-                error_records.append(error)
-        
-        if not errors_needing_reminder:
+        if not error_records:
             return 0
         
         # Invia reminder
         emails_sent = self._send_notifications(
-            query, errors_needing_reminder, columns, email_type='reminder'
+            query, [e.get_error_data() for e in error_records], columns,
+            email_type='reminder'
         )
         
-        # Aggiorna contatori reminder
+        # Aggiorna contatori reminder con un solo UPDATE
         if emails_sent > 0:
-            for error in error_records:
-                error.last_reminder_at = get_utc_now()
-                error.reminder_count += 1
+            ErrorRecord.query.filter(
+                ErrorRecord.id.in_([e.id for e in error_records])
+            ).update({
+                ErrorRecord.last_reminder_at: get_utc_now(),
+                ErrorRecord.reminder_count: ErrorRecord.reminder_count + 1
+            })
             db.session.commit()
         
         return emails_sent
     
     def _log_execution(self, query: MonitoredQuery, result: dict, start_time: float):
-        """Registra l'esecuzione nel log."""
+        """
+        Accoda l'esecuzione per il log. I QueryLog vengono scritti in blocco
+        ogni QUERY_LOG_BATCH_SIZE esecuzioni, dallo scheduler a ogni ciclo,
+        dopo ogni esecuzione forzata e allo shutdown.
+        """
         execution_time = int((time.time() - start_time) * 1000)
         
-        log_entry = QueryLog(
-            query_id=query.id,
-            status=result['status'],
-            rows_returned=result['rows_returned'],
-            new_errors=result['new_errors'],
-            resolved_errors=result['resolved_errors'],
-            reminders_sent=result.get('reminders_sent', 0),
-            emails_sent=result['emails_sent'],
-            execution_time_ms=execution_time,
-            error_message=result['error_message']
-        )
-        db.session.add(log_entry)
+        self._pending_logs.append(({
+            'query_id': query.id,
+            'executed_at': get_utc_now(),
+            'status': result['status'],
+            'rows_returned': result['rows_returned'],
+            'new_errors': result['new_errors'],
+            'resolved_errors': result['resolved_errors'],
+            'reminders_sent': result.get('reminders_sent', 0),
+            'emails_sent': result['emails_sent'],
+            'execution_time_ms': execution_time,
+            'error_message': result['error_message']
+        }, 0))
+        
+        if len(self._pending_logs) >= self.log_batch_size:
+            self.flush_logs()
+    
+    def flush_logs(self) -> int:
+        """
+        Scrive in un'unica INSERT i log di esecuzione in attesa.
+        
+        Se l'INSERT in blocco fallisce i log vengono scritti uno alla volta:
+        quelli che falliscono ancora tornano in coda e vengono scartati dopo
+        MAX_LOG_FLUSH_ATTEMPTS tentativi, così una riga non valida non blocca
+        i log successivi.
+        
+        Returns:
+            int: Numero di log scritti
+        """
+        # Svuota la coda con popleft (atomico): i log accodati da altri
+        # thread durante il flush restano in coda per il flush successivo
+        pending = []
+        try:
+            while True:
+                pending.append(self._pending_logs.popleft())
+        except IndexError:
+            pass
+        
+        if not pending:
+            return 0
         
         try:
+            db.session.bulk_insert_mappings(QueryLog, [row for row, _ in pending])
             db.session.commit()
+            return len(pending)
         except Exception as e:
             logger.error(f"Errore salvataggio log: {e}")
             db.session.rollback()
+        
+        # Fallback riga per riga: solo i log che falliscono restano in coda
+        written = 0
+        failed = []
+        for row, attempts in pending:
+            try:
+                db.session.bulk_insert_mappings(QueryLog, [row])
+                db.session.commit()
+                written += 1
+            except Exception as e:
+                db.session.rollback()
+                attempts += 1
+                if attempts >= MAX_LOG_FLUSH_ATTEMPTS:
+                    logger.error(
+                        f"Log esecuzione query {row.get('query_id')} scartato "
+                        f"dopo {attempts} tentativi: {e}"
+                    )
+                else:
+                    failed.append((row, attempts))
+        
+        self._requeue_logs(failed)
+        return written
+    
+    def _requeue_logs(self, failed: list):
+        """
+        Rimette in testa alla coda i log non scritti (i più vecchi).
+        Se non c'è spazio scarta i più vecchi, come fa la coda piena con
+        append: extendleft su una deque piena scarterebbe invece i più recenti.
+        """
+        room = self._pending_logs.maxlen - len(self._pending_logs)
+        if len(failed) > room:
+            dropped = len(failed) - max(room, 0)
+            logger.error(f"Coda log piena: scartati {dropped} log di esecuzione")
+            failed = failed[dropped:]
+        self._pending_logs.extendleft(reversed(failed))
+    
+    def _flush_logs_at_exit(self):
+        """Handler atexit: scrive i log in coda prima della chiusura."""
+        if not self._pending_logs or self.app is None:
+            return
+        try:
+            with self.app.app_context():
+                self.flush_logs()
+        except Exception as e:
+            logger.error(f"Errore salvataggio log allo shutdown: {e}")
     
     def check_all_active_queries(self) -> list:
         """
@@ -365,21 +483,12 @@ class MonitorService:
             return {'error': 'Query non trovata'}
         
         # Conta errori attivi
-        active_errors = ErrorRecord.query.filter_by(
-            query_id=query_id,
-            resolved_at=None
-        ).count()
+        active_errors = ErrorRecord.active_error_count(query_id)
         
         # Conta errori con reminder pendenti
         pending_reminders = 0
         if query.reminder_enabled:
-            for error in ErrorRecord.query.filter_by(
-                query_id=query_id,
-                resolved_at=None,
-                email_sent=True
-            ).all():
-                if error.needs_reminder(query):
-                    pending_reminders += 1
+            pending_reminders = ErrorRecord.due_for_reminder(query).count()
         
         # Ultimo log
         last_log = QueryLog.query.filter_by(
@@ -416,17 +525,26 @@ class MonitorService:
             query_id: Opzionale, filtra per query specifica
             include_data: Se True, include i dati completi dell'errore
         """
-        errors_query = ErrorRecord.query.filter_by(resolved_at=None)
+        # Righe lette a blocchi (yield_per) e nome query via join: niente
+        # lazy load di monitored_query per ogni errore
+        stmt = (
+            db.select(ErrorRecord, MonitoredQuery.name)
+            .join(MonitoredQuery, ErrorRecord.query_id == MonitoredQuery.id)
+            .filter(ErrorRecord.resolved_at == None)
+        )
         
         if query_id:
-            errors_query = errors_query.filter_by(query_id=query_id)
+            stmt = stmt.filter(ErrorRecord.query_id == query_id)
         
-        errors = errors_query.order_by(ErrorRecord.first_seen_at.desc()).all()
+        stmt = (
+            stmt.order_by(ErrorRecord.first_seen_at.desc())
+            .execution_options(yield_per=1000)
+        )
         
         return [{
             'id': e.id,
             'query_id': e.query_id,
-            'query_name': e.monitored_query.name,
+            'query_name': query_name,
             'error_hash': e.error_hash[:12] + '...',
             'error_data': e.get_error_data() if include_data else None,
             'first_seen_at': e.first_seen_at,
@@ -436,7 +554,7 @@ class MonitorService:
             'email_sent_at': e.email_sent_at,
             'reminder_count': e.reminder_count,
             'last_reminder_at': e.last_reminder_at
-        } for e in errors]
+        } for e, query_name in db.session.execute(stmt)]
     
     def test_query_connection(self, query_id: int) -> dict:
         """Testa la connessione/query di una consultazione."""
@@ -13,7 +13,7 @@ from email_service import email_service
 from monitor_service import monitor_service
 from notification_service import notification_service
 from cleanup_service import cleanup_service
-from routing_service import get_operators_list, apply_routing_rules, get_routing_summary
+from routing_service import get_operators_list, route_with_summary
 from data_sources import test_query_source
 from validators import validate_routing_rule, sanitize_string
 from utils import get_utc_now
@@ -246,8 +246,7 @@ def api_test_routing(query_id):
             'routing_result': {}
         })
     
-    summary = get_routing_summary(query, test_errors)
-    routing_result = apply_routing_rules(query, test_errors)
+    routing_result, summary = route_with_summary(query, test_errors)
     
     # Formatta risultato per UI
     formatted_result = {}
@@ -7,7 +7,7 @@ from datetime import datetime, time
 from db_drivers import get_available_drivers, DRIVER_LABELS
 from models import (db, MonitoredQuery, ErrorRecord, QueryLog, EmailLog,
                     DatabaseConnection, NotificationChannel)
-from routing_service import get_operators_list
+from routing_service import get_operators_list, forget_routing_program
 from utils import get_utc_now
 
 import json
@@ -300,6 +300,7 @@ def query_delete(query_id):
     try:
         db.session.delete(query)
         db.session.commit()
+        forget_routing_program(query_id)
         flash(_('query_deleted_success', name=name), 'success')
     except Exception as e:
         db.session.rollback()
@@ -3,13 +3,25 @@ Routing Service - Logica per il routing condizionale delle notifiche.
 Permette di indirizzare errori a destinatari diversi in base ai valori dei campi.
 """
 import re
+import sys
 import logging
-from collections import defaultdict
+import operator
+import threading
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
 from flask_babel import lazy_gettext as _l
-from models import MonitoredQuery, RoutingRule, RoutingCondition
+from models import db, MonitoredQuery, RoutingRule, RoutingCondition
 
 logger = logging.getLogger(__name__)
 
+# Motore regex opzionale a tempo lineare (niente backtracking catastrofico
+# su pattern scritti dagli utenti); senza re2 si usa il modulo re
+try:
+    import re2
+except ImportError:
+    re2 = None
+    logger.debug("re2 non disponibile, regex di routing con re (pip install google-re2)")
+
 
 # Operatori disponibili per le condizioni
 OPERATORS = {
@@ -45,13 +57,13 @@ OPERATORS = {
     },
     'in': {
         'label': _l('operator_in'),
-        'fn': lambda f, v, cs: (f if cs else f.lower()) in [x.strip() if cs else x.strip().lower() for x in v.split(',')],
+        'fn': lambda f, v, cs: (f if cs else f.lower()) in _value_set(v, cs),
         'needs_value': True,
         'value_hint': _l('operator_in_hint'),
     },
     'not_in': {
         'label': _l('operator_not_in'),
-        'fn': lambda f, v, cs: (f if cs else f.lower()) not in [x.strip() if cs else x.strip().lower() for x in v.split(',')],
+        'fn': lambda f, v, cs: (f if cs else f.lower()) not in _value_set(v, cs),
         'needs_value': True,
         'value_hint': _l('operator_not_in_hint'),
     },
@@ -98,6 +110,14 @@ OPERATORS = {
 }
 
 
+@lru_cache(maxsize=1024)
+def _value_set(value, case_sensitive):
+    """Lista separata da virgola come frozenset (memoizzato per in/not_in)."""
+    if not case_sensitive:
+        value = value.lower()
+    return frozenset(x.strip() for x in value.split(','))
+
+
 def _numeric_compare(field_value, compare_value, comparator):
     """Helper per confronti numerici con gestione errori."""
     try:
@@ -118,74 +138,220 @@ def _regex_match(field_value, pattern, case_sensitive):
         return False
 
 
-def get_field_value(error: dict, field_name: str):
+def field_key_map(error: dict) -> dict:
+    """
+    Mappa nome campo in maiuscolo -> chiave originale dell'errore.
+    A parità di nome vince la prima chiave, come in get_field_value.
+    """
+    key_map = {}
+    for key in error:
+        key_map.setdefault(key.upper(), key)
+    return key_map
+
+
+def get_field_value(error: dict, field_name: str, key_map: dict = None):
     """
     Ottiene il valore di un campo dall'errore (case-insensitive).
     
     Args:
         error: dizionario con i dati dell'errore
         field_name: nome del campo da cercare
+        key_map: opzionale, mappa da field_key_map() per errori con le stesse
+                 chiavi; evita la scansione di tutte le chiavi
         
     Returns:
         Il valore del campo o None se non trovato
     """
+    if key_map is not None:
+        key = key_map.get(field_name.upper())
+        return None if key is None else error[key]
+    
     for key, value in error.items():
         if key.upper() == field_name.upper():
             return value
     return None
 
 
-def evaluate_condition(error: dict, condition: RoutingCondition) -> bool:
+# Comparatori per gli operatori numerici
+NUMERIC_COMPARATORS = {
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+
+
+# Costo stimato di valutazione per operatore (0 = più economico).
+# Le condizioni di una regola vengono valutate dalla più economica, così
+# AND/OR si fermano prima di arrivare a regex e confronti numerici.
+OPERATOR_COSTS = {
+    'is_empty': 0, 'is_not_empty': 0,
+    'equals': 0, 'not_equals': 0, 'in': 0, 'not_in': 0,
+    'contains': 1, 'not_contains': 1, 'startswith': 1, 'endswith': 1,
+    'gt': 2, 'gte': 2, 'lt': 2, 'lte': 2,
+    'regex': 3,
+}
+
+
+def condition_cost(condition: RoutingCondition) -> int:
+    """Costo stimato di una condizione (vedi OPERATOR_COSTS)."""
+    return OPERATOR_COSTS.get(condition.operator, 0)
+
+
+@lru_cache(maxsize=256)
+def _cost_order(operators: tuple) -> tuple:
+    """Posizioni delle condizioni ordinate per costo dei loro operatori (stabile)."""
+    return tuple(sorted(range(len(operators)), key=lambda i: OPERATOR_COSTS.get(operators[i], 0)))
+
+
+def compile_condition(condition: RoutingCondition):
+    """
+    Compila una condizione in un predicato field_value -> bool.
+    
+    Operatore, case sensitivity e valore di confronto vengono risolti una
+    volta sola (lower-case, split delle liste, regex, soglie numeriche):
+    il predicato riceve solo il valore grezzo del campo (anche None).
+    
+    Args:
+        condition: RoutingCondition da compilare
+        
+    Returns:
+        Callable[[Any], bool]
+    """
+    return _compile_predicate(
+        condition.operator, condition.value or '', bool(condition.case_sensitive)
+    )
+
+
+def _compile_regex(pattern: str, case_sensitive: bool):
+    """
+    Compila un pattern con re2 se disponibile, altrimenti (o se re2 non
+    supporta il pattern, es. backreference e lookaround) con re.
+    
+    Raises:
+        re.error: pattern non valido
+    """
+    if re2 is not None:
+        try:
+            return re2.compile(pattern if case_sensitive else f'(?i){pattern}')
+        except Exception:
+            pass
+    return re.compile(pattern, 0 if case_sensitive else re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def _compile_predicate(op: str, value: str, case_sensitive: bool):
+    """Costruisce il predicato specializzato (memoizzato sul contenuto)."""
+    if op not in OPERATORS:
+        logger.warning(f"Operatore non riconosciuto: {op}")
+        return lambda f: False
+    
+    if op == 'is_empty':
+        return lambda f: f is None or str(f).strip() == ''
+    if op == 'is_not_empty':
+        return lambda f: f is not None and str(f).strip() != ''
+    
+    if op == 'regex':
+        try:
+            pattern = _compile_regex(value, case_sensitive)
+        except re.error:
+            logger.warning(f"Pattern regex non valido: {value}")
+            return lambda f: False
+        return lambda f: pattern.search('' if f is None else str(f)) is not None
+    
+    if op in NUMERIC_COMPARATORS:
+        comparator = NUMERIC_COMPARATORS[op]
+        try:
+            threshold = float(value)
+        except ValueError:
+            return lambda f: False
+        
+        def numeric(f):
+            try:
+                return comparator(float(str(f)), threshold)
+            except (ValueError, TypeError):
+                return False
+        return numeric
+    
+    # Operatori testuali: il valore del campo viene normalizzato (str,
+    # minuscolo se case insensitive) e passato al predicato testuale
+    text_predicate = _compile_text_predicate(op, value, case_sensitive)
+    if case_sensitive:
+        return lambda f: text_predicate('' if f is None else str(f))
+    return lambda f: text_predicate('' if f is None else str(f).lower())
+
+
+# Operatori che confrontano il campo come testo (vedi _compile_text_predicate)
+TEXT_OPERATORS = frozenset({
+    'equals', 'not_equals', 'contains', 'not_contains',
+    'startswith', 'endswith', 'in', 'not_in',
+})
+
+
+@lru_cache(maxsize=1024)
+def _compile_text_predicate(op: str, value: str, case_sensitive: bool):
+    """
+    Predicato testuale su un valore già normalizzato: str, e in minuscolo
+    se case insensitive. Il valore di confronto è normalizzato qui una volta.
+    """
+    if not case_sensitive:
+        value = value.lower()
+    
+    if op in ('equals', 'not_equals'):
+        # Internato come i valori brevi delle colonne (vedi _text_column):
+        # per i valori tipo enum (CRITICAL, OPEN, ...) il confronto si
+        # risolve sul controllo di identità di str.__eq__
+        value = sys.intern(value)
+    
+    if op == 'equals':
+        return lambda t: t == value
+    if op == 'not_equals':
+        return lambda t: t != value
+    if op == 'contains':
+        return lambda t: value in t
+    if op == 'not_contains':
+        return lambda t: value not in t
+    if op == 'startswith':
+        return lambda t: t.startswith(value)
+    if op == 'endswith':
+        return lambda t: t.endswith(value)
+    
+    items = _value_set(value, True)  # già in minuscolo se case insensitive
+    if op == 'in':
+        return lambda t: t in items
+    return lambda t: t not in items  # not_in
+
+
+def evaluate_condition(error: dict, condition: RoutingCondition,
+                       key_map: dict = None) -> bool:
     """
     Valuta se un errore soddisfa una singola condizione.
     
     Args:
         error: dizionario con i dati dell'errore
         condition: RoutingCondition da valutare
+        key_map: opzionale, vedi get_field_value
         
     Returns:
         True se la condizione è soddisfatta
     """
-    # Ottieni valore del campo
-    field_value = get_field_value(error, condition.field_name)
-    
-    # Gestione None/NULL
-    if field_value is None:
-        if condition.operator == 'is_empty':
-            return True
-        elif condition.operator == 'is_not_empty':
-            return False
-        field_value = ''
-    
-    # Prepara valori per confronto
-    field_str = str(field_value)
-    compare_value = condition.value or ''
-    
-    # Case sensitivity
-    if not condition.case_sensitive:
-        field_str = field_str.lower()
-        compare_value = compare_value.lower()
-    
-    # Ottieni operatore e valuta
-    operator_def = OPERATORS.get(condition.operator)
-    if not operator_def:
-        logger.warning(f"Operatore non riconosciuto: {condition.operator}")
-        return False
+    predicate = compile_condition(condition)
     
     try:
-        return operator_def['fn'](field_str, compare_value, condition.case_sensitive)
+        return predicate(get_field_value(error, condition.field_name, key_map))
     except Exception as e:
         logger.error(f"Errore valutazione condizione: {e}")
         return False
 
 
-def evaluate_rule(error: dict, rule: RoutingRule) -> bool:
+def evaluate_rule(error: dict, rule: RoutingRule, key_map: dict = None) -> bool:
     """
     Valuta se un errore soddisfa tutte/alcune condizioni di una regola.
     
     Args:
         error: dizionario con i dati dell'errore
         rule: RoutingRule da valutare
+        key_map: opzionale, vedi get_field_value
         
     Returns:
         True se la regola è soddisfatta
@@ -197,68 +363,531 @@ def evaluate_rule(error: dict, rule: RoutingRule) -> bool:
         # Regola senza condizioni = sempre match (catch-all)
         return True
     
-    results = [evaluate_condition(error, cond) for cond in rule.conditions]
+    # Valutazione short-circuit, dalle condizioni più economiche
+    # (ordine calcolato una volta per combinazione di operatori)
+    order = _cost_order(tuple(c.operator for c in rule.conditions))
+    conditions = [rule.conditions[i] for i in order]
     
     if rule.condition_logic == 'OR':
-        return any(results)
+        for cond in conditions:
+            if evaluate_condition(error, cond, key_map):
+                return True
+        return False
     else:  # AND (default)
-        return all(results)
+        for cond in conditions:
+            if not evaluate_condition(error, cond, key_map):
+                return False
+        return True
 
 
-def apply_routing_rules(query: MonitoredQuery, errors: list) -> dict:
+def _batch_key_maps(errors: list) -> list:
     """
-    Applica le regole di routing e raggruppa gli errori per destinatario.
+    Mappe dei campi (field_key_map) per ogni errore del batch.
+    Gli errori di una stessa sorgente hanno di solito le stesse chiavi:
+    la mappa viene costruita una volta per forma e condivisa.
+    """
+    by_shape = {}
+    key_maps = []
+    for error in errors:
+        shape = tuple(error)
+        key_map = by_shape.get(shape)
+        if key_map is None:
+            key_map = by_shape[shape] = field_key_map(error)
+        key_maps.append(key_map)
+    return key_maps
+
+
+def _condition_mask(predicate, values: list) -> list:
+    """
+    Applica un predicato compilato a una colonna di valori.
+    In caso di eccezione ricade sulla valutazione per singolo valore,
+    con lo stesso comportamento di evaluate_condition (False + log).
+    """
+    try:
+        return [bool(predicate(v)) for v in values]
+    except Exception:
+        pass
+    
+    mask = []
+    for v in values:
+        try:
+            mask.append(bool(predicate(v)))
+        except Exception as e:
+            logger.error(f"Errore valutazione condizione: {e}")
+            mask.append(False)
+    return mask
+
+
+def _to_float(value):
+    """float(str(value)) o None se il valore non è numerico."""
+    try:
+        return float(str(value))
+    except (ValueError, TypeError):
+        return None
+
+
+def _numeric_mask(condition: RoutingCondition, numbers: list) -> list:
+    """
+    Confronto numerico su una colonna già convertita con _to_float:
+    niente parsing né try/except per valore.
+    """
+    threshold = _to_float(condition.value or '')
+    if threshold is None:
+        return [False] * len(numbers)
+    
+    comparator = NUMERIC_COMPARATORS[condition.operator]
+    return [x is not None and comparator(x, threshold) for x in numbers]
+
+
+# Numero minimo di condizioni regex (stesso campo, regola OR) oltre il
+# quale vengono unite in un'unica alternanza valutata con una sola scansione
+REGEX_UNION_MIN = 4
+
+# Riferimenti a gruppi per numero/nome: non sopravvivono all'unione.
+# Un falso positivo (es. un backslash escapato prima di una cifra) fa solo
+# saltare l'ottimizzazione.
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+@lru_cache(maxsize=1024)
+def _regex_compiles(pattern: str, case_sensitive: bool) -> bool:
+    """True se il pattern compila da solo (memoizzato sul contenuto)."""
+    try:
+        _compile_regex(pattern, case_sensitive)
+    except re.error:
+        return False
+    return True
+
+
+@lru_cache(maxsize=256)
+def _compile_regex_union(patterns: tuple, case_sensitive: bool):
+    """
+    Predicato unico equivalente all'OR di più condizioni regex.
+    I pattern devono compilare singolarmente (vedi _or_regex_groups).
+    
+    Returns:
+        Callable[[Any], bool] oppure None se i pattern non si possono unire
+        (pattern non validi, flag globali inline)
+    """
+    try:
+        union = _compile_regex('|'.join(f'(?:{p})' for p in patterns), case_sensitive)
+    except re.error:
+        return None
+    return lambda f: union.search('' if f is None else str(f)) is not None
+
+
+def _or_regex_groups(conditions: list):
+    """
+    Separa le condizioni di una regola OR in gruppi di regex unibili
+    ({(CAMPO, case_sensitive): [condizioni]}) e condizioni restanti.
+    Si uniscono solo pattern validi da soli: unendo il testo grezzo un
+    pattern non valido (es. 'a)|(b') potrebbe diventare valido, mentre
+    valutato da solo non corrisponde mai.
+    """
+    groups = defaultdict(list)
+    for cond in conditions:
+        if cond.operator != 'regex':
+            continue
+        pattern = cond.value or ''
+        if _GROUP_REFERENCE.search(pattern) or not _regex_compiles(pattern, bool(cond.case_sensitive)):
+            continue
+        groups[(cond.field_name.upper(), bool(cond.case_sensitive))].append(cond)
+    
+    unions = {}
+    for key, group in groups.items():
+        if len(group) >= REGEX_UNION_MIN:
+            predicate = _compile_regex_union(
+                tuple(c.value or '' for c in group), key[1]
+            )
+            if predicate is not None:
+                unions[key] = (predicate, group)
+    
+    grouped = {id(c) for _, group in unions.values() for c in group}
+    rest = [c for c in conditions if id(c) not in grouped]
+    return unions, rest
+
+
+@lru_cache(maxsize=256)
+def _recipients_tuple(raw: str) -> tuple:
+    """
+    Destinatari separati da virgola, normalizzati in minuscolo e internati,
+    senza duplicati e nell'ordine originale (memoizzato sul testo).
+    'Foo@Example.com' e 'foo@example.com' diventano un solo destinatario.
+    """
+    recipients = (sys.intern(r.strip().lower()) for r in (raw or '').split(',') if r.strip())
+    return tuple(dict.fromkeys(recipients))
+
+
+class CompiledCondition:
+    """Condizione di routing con il predicato già compilato."""
+    
+    def __init__(self, field_name, operator, value, case_sensitive):
+        self.field_name = field_name
+        self.operator = operator
+        self.value = value
+        self.case_sensitive = case_sensitive
+        self.predicate = compile_condition(self)
+        # Operatori testuali: nel batch si valuta sulla colonna già normalizzata
+        self.text_predicate = None
+        self.text_value = None
+        if operator in TEXT_OPERATORS:
+            self.text_predicate = _compile_text_predicate(
+                operator, value or '', bool(case_sensitive)
+            )
+            # Valore di confronto normalizzato come le colonne di BatchColumns
+            text_value = value or ''
+            self.text_value = sys.intern(text_value if case_sensitive else text_value.lower())
+
+
+class RegexUnion:
+    """
+    Più condizioni regex di una regola OR sullo stesso campo, unite in una
+    sola alternanza. Valutata nel batch come una condizione regex.
+    """
+    
+    operator = 'regex'
+    text_predicate = None
+    
+    def __init__(self, field_name, case_sensitive, predicate):
+        self.field_name = field_name
+        self.case_sensitive = case_sensitive
+        self.predicate = predicate
+
+
+class CompiledRule:
+    """
+    Regola attiva pronta per la valutazione a colonne: destinatari già
+    separati, predicati compilati e, per le regole OR, regex già unite.
+    """
+    
+    def __init__(self, rule_id, condition_logic, recipients, stop_on_match, conditions):
+        self.id = rule_id
+        self.condition_logic = condition_logic
+        self.stop_on_match = bool(stop_on_match)
+        self.recipients = _recipients_tuple(recipients)
+        # Regola senza condizioni = sempre match (catch-all)
+        self.catch_all = not conditions
+        
+        if condition_logic == 'OR':
+            # Più regex sullo stesso campo: una sola alternanza al posto di N scansioni
+            unions, conditions = _or_regex_groups(conditions)
+            conditions = conditions + [
+                RegexUnion(field, case_sensitive, predicate)
+                for (field, case_sensitive), (predicate, _) in unions.items()
+            ]
+        # Ordinate una volta per costo: la valutazione si ferma prima
+        # di arrivare a regex e confronti numerici
+        self.conditions = sorted(conditions, key=condition_cost)
+
+
+# Programmi di routing compilati: {query_id: (firma delle regole, [CompiledRule])}.
+# LRU limitata a PROGRAM_CACHE_MAX query; le query eliminate vengono
+# rimosse subito (forget_routing_program)
+PROGRAM_CACHE_MAX = 256
+_program_cache = OrderedDict()
+_program_cache_lock = threading.Lock()
+
+
+def _rules_fingerprint(query_id: int) -> tuple:
+    """
+    Contenuto delle regole attive della query (con le condizioni) in una
+    sola SELECT di colonne, ordinato per priorità: fa da chiave della cache.
+    """
+    rows = db.session.execute(
+        db.select(
+            RoutingRule.id, RoutingRule.condition_logic, RoutingRule.recipients,
+            RoutingRule.stop_on_match, RoutingCondition.field_name,
+            RoutingCondition.operator, RoutingCondition.value,
+            RoutingCondition.case_sensitive,
+        )
+        .outerjoin(RoutingCondition, RoutingCondition.rule_id == RoutingRule.id)
+        .where(RoutingRule.query_id == query_id, RoutingRule.is_active == True)
+        .order_by(RoutingRule.priority, RoutingRule.id, RoutingCondition.id)
+    ).all()
+    return tuple(tuple(row) for row in rows)
+
+
+def _compile_program(fingerprint: tuple) -> list:
+    """Costruisce le CompiledRule dalle righe di _rules_fingerprint."""
+    rules = []
+    current_id = None
+    conditions = []
+    for rule_id, logic, recipients, stop, field, op, value, cs in fingerprint:
+        if rule_id != current_id:
+            conditions = []
+            rules.append((rule_id, logic, recipients, stop, conditions))
+            current_id = rule_id
+        if field is not None:
+            conditions.append(CompiledCondition(field, op, value, cs))
+    return [CompiledRule(*rule) for rule in rules]
+
+
+def load_routing_program(query: MonitoredQuery) -> list:
+    """
+    Regole attive della query compilate e ordinate per priorità.
+    
+    La compilazione viene riusata finché il contenuto delle regole non
+    cambia: ogni chiamata costa una sola SELECT per la firma.
+    
+    Returns:
+        list[CompiledRule]
+    """
+    fingerprint = _rules_fingerprint(query.id)
+    with _program_cache_lock:
+        cached = _program_cache.get(query.id)
+        if cached is not None and cached[0] == fingerprint:
+            _program_cache.move_to_end(query.id)
+            return cached[1]
+    
+    program = _compile_program(fingerprint)
+    with _program_cache_lock:
+        _program_cache[query.id] = (fingerprint, program)
+        _program_cache.move_to_end(query.id)
+        while len(_program_cache) > PROGRAM_CACHE_MAX:
+            _program_cache.popitem(last=False)
+    return program
+
+
+def forget_routing_program(query_id: int):
+    """Rimuove dalla cache il programma compilato di una query (es. eliminata)."""
+    with _program_cache_lock:
+        _program_cache.pop(query_id, None)
+
+
+def program_fields(program: list) -> set:
+    """Campi (in maiuscolo) letti dalle condizioni delle regole compilate."""
+    fields = set()
+    for rule in program:
+        fields.update(cond.field_name.upper() for cond in rule.conditions)
+    return fields
+
+
+# Lunghezza massima dei valori testuali internati nelle colonne del batch:
+# i valori brevi (stati, severità, codici) si ripetono molto tra gli errori
+INTERN_MAX_LENGTH = 64
+
+
+class BatchColumns:
+    """
+    Colonne dei campi per un batch di errori. Ogni campo viene estratto e
+    convertito (numero, testo normalizzato) al più una volta per errore e
+    condiviso tra tutte le regole e condizioni che lo usano.
+    
+    I metodi ricevono gli indici (in errors) degli errori da valutare e
+    restituiscono i valori nello stesso ordine.
+    """
+    
+    def __init__(self, errors: list, fields=()):
+        self.errors = errors
+        self.key_maps = _batch_key_maps(errors)
+        self._values = {}   # CAMPO -> [valore grezzo per errore]
+        self._numbers = {}  # CAMPO -> {indice: float | None}
+        self._texts = {}    # (CAMPO, case_sensitive) -> {indice: str | None}
+        self._buckets = {}  # (CAMPO, case_sensitive) -> (indici, {testo: [posizioni]})
+        
+        # Colonne dei campi usati dalle regole estratte subito, in un
+        # passaggio per campo su tutto il batch
+        for field in fields:
+            self._column(field.upper())
+    
+    def _column(self, field: str) -> list:
+        """Colonna completa dei valori grezzi di un campo (già in maiuscolo)."""
+        column = self._values.get(field)
+        if column is None:
+            column = self._values[field] = [
+                get_field_value(error, field, key_map)
+                for error, key_map in zip(self.errors, self.key_maps)
+            ]
+        return column
+    
+    def values(self, field_name: str, indexes: list) -> list:
+        """Valori grezzi del campo (None se assente)."""
+        column = self._column(field_name.upper())
+        if len(indexes) == len(column):
+            # indexes è sempre crescente e senza duplicati: è tutto il batch
+            return column
+        return [column[i] for i in indexes]
+    
+    def numbers(self, field_name: str, indexes: list) -> list:
+        """Valori del campo convertiti con _to_float (None se non numerici)."""
+        field = field_name.upper()
+        column = self._numbers.setdefault(field, {})
+        missing = [i for i in indexes if i not in column]
+        for i, value in zip(missing, self.values(field, missing)):
+            column[i] = _to_float(value)
+        return [column[i] for i in indexes]
+    
+    def texts(self, field_name: str, case_sensitive: bool, indexes: list) -> list:
+        """
+        Valori del campo come testo normalizzato: '' se assente, minuscolo
+        se case insensitive, internato se breve. None se str() fallisce.
+        """
+        field = field_name.upper()
+        column = self._texts.setdefault((field, case_sensitive), {})
+        missing = [i for i in indexes if i not in column]
+        for i, value in zip(missing, self.values(field, missing)):
+            try:
+                text = '' if value is None else str(value)
+                if not case_sensitive:
+                    text = text.lower()
+                if len(text) <= INTERN_MAX_LENGTH:
+                    text = sys.intern(text)
+                column[i] = text
+            except Exception as e:
+                logger.error(f"Errore valutazione condizione: {e}")
+                column[i] = None
+        return [column[i] for i in indexes]
+    
+    def equals_buckets(self, field_name: str, case_sensitive: bool, indexes: list) -> dict:
+        """
+        Posizioni (in indexes) raggruppate per testo normalizzato del campo.
+        Costruito una volta per lista di indici e condiviso tra tutte le
+        condizioni equals sullo stesso campo.
+        """
+        key = (field_name.upper(), case_sensitive)
+        cached = self._buckets.get(key)
+        if cached is not None and cached[0] is indexes:
+            return cached[1]
+        
+        buckets = defaultdict(list)
+        for position, text in enumerate(self.texts(field_name, case_sensitive, indexes)):
+            if text is not None:
+                buckets[text].append(position)
+        self._buckets[key] = (indexes, buckets)
+        return buckets
+
+
+def _batch_condition_mask(cond: CompiledCondition, indexes: list, columns: BatchColumns) -> list:
+    """
+    Valuta una condizione compilata sugli errori indicati del batch.
+    
+    Returns:
+        list[bool]: per ogni indice, True se la condizione è soddisfatta
+    """
+    if cond.operator in NUMERIC_COMPARATORS:
+        return _numeric_mask(cond, columns.numbers(cond.field_name, indexes))
+    
+    if cond.operator == 'equals':
+        # Lookup nei gruppi per valore invece di un confronto per errore
+        buckets = columns.equals_buckets(cond.field_name, bool(cond.case_sensitive), indexes)
+        mask = [False] * len(indexes)
+        for position in buckets.get(cond.text_value, ()):
+            mask[position] = True
+        return mask
+    
+    if cond.text_predicate is not None:
+        texts = columns.texts(cond.field_name, bool(cond.case_sensitive), indexes)
+        predicate = cond.text_predicate
+        return [t is not None and predicate(t) for t in texts]
+    
+    return _condition_mask(cond.predicate, columns.values(cond.field_name, indexes))
+
+
+def _rule_hits(rule: CompiledRule, indexes: list, columns: BatchColumns) -> list:
+    """
+    Valuta una regola sugli errori del batch ancora da instradare.
+    
+    Short-circuit a colonne: le condizioni (già in ordine di costo) vengono
+    valutate solo sugli errori ancora indecisi. Con AND restano in gioco
+    quelli che le soddisfano, con OR quelli che non hanno ancora un match;
+    ci si ferma appena non ne resta nessuno.
     
     Args:
-        query: MonitoredQuery con le regole configurate
-        errors: lista di dizionari con i dati degli errori
+        rule: CompiledRule da valutare
+        indexes: indici (in errors, crescenti) degli errori da valutare
+        columns: BatchColumns del batch
         
     Returns:
-        dict: {recipient: [errors]} 
-              - Se routing disabilitato: {tuple(recipients): all_errors}
-              - Se routing abilitato: {recipient1: [err1, err3], recipient2: [err2], ...}
+        list[int]: indici (crescenti) degli errori che soddisfano la regola
+    """
+    if rule.catch_all:
+        return indexes
+    
+    is_or = rule.condition_logic == 'OR'
+    pending = indexes
+    hits = []
+    for cond in rule.conditions:
+        mask = _batch_condition_mask(cond, pending, columns)
+        if is_or:
+            hits.extend(i for i, hit in zip(pending, mask) if hit)
+            pending = [i for i, hit in zip(pending, mask) if not hit]
+        else:
+            pending = [i for i, hit in zip(pending, mask) if hit]
+        if not pending:
+            break
+    
+    if is_or:
+        return sorted(hits)
+    return pending
+
+
+def _route_errors(query: MonitoredQuery, errors: list) -> tuple:
+    """
+    Nucleo di apply_routing_rules e get_routing_summary.
+    
+    Returns:
+        tuple: (risultato come apply_routing_rules,
+                numero di errori che non finiscono in nessuna lista;
+                0 con routing disabilitato)
     """
     if not query.routing_enabled:
         # Comportamento classico: tutti gli errori a tutti i destinatari
-        recipients = tuple(query.get_recipients_list())
+        recipients = _recipients_tuple(query.email_recipients)
         if recipients:
-            return {recipients: errors}
-        return {}
+            return {recipients: errors}, 0
+        return {}, 0
     
-    # Routing abilitato: valuta regole per ogni errore
-    recipient_errors = defaultdict(list)
-    unmatched_errors = []
+    # Routing abilitato: valutazione a colonne, una condizione alla volta
+    # su tutti gli errori del batch invece di errore per errore
+    program = load_routing_program(query)
+    columns = BatchColumns(errors, program_fields(program))
+    # Indici degli errori per destinatario: un errore catturato da più
+    # regole con lo stesso destinatario compare una volta sola
+    routed = defaultdict(set)
+    # Indici degli errori assegnati ad almeno un destinatario da una regola
+    matched = set()
+    # Errori ancora in gioco: quelli catturati da una regola con
+    # stop_on_match non vengono più valutati dalle regole successive
+    remaining = list(range(len(errors)))
     
-    # Ordina regole per priorità
-    sorted_rules = sorted(query.routing_rules, key=lambda r: r.priority)
-    
-    for error in errors:
-        matched_recipients = set()
-        should_stop = False
+    # Regole attive compilate (ciclo esterno), già ordinate per priorità
+    for rule in program:
+        # Catch-all: prende tutti gli errori ancora in gioco
+        hits = _rule_hits(rule, remaining, columns)
+        if not hits:
+            continue
         
-        for rule in sorted_rules:
-            if should_stop:
+        for recipient in rule.recipients:
+            routed[recipient].update(hits)
+        if rule.recipients:
+            matched.update(hits)
+        if rule.stop_on_match:
+            if hits is remaining:
+                remaining = []
+            else:
+                caught = set(hits)
+                remaining = [i for i in remaining if i not in caught]
+            if not remaining:
+                # Tutti gli errori già catturati: le regole successive non servono
                 break
-                
-            if evaluate_rule(error, rule):
-                for recipient in rule.get_recipients_list():
-                    matched_recipients.add(recipient)
-                
-                if rule.stop_on_match:
-                    should_stop = True
-        
-        if matched_recipients:
-            for recipient in matched_recipients:
-                recipient_errors[recipient].append(error)
-        else:
-            unmatched_errors.append(error)
+    
+    recipient_errors = defaultdict(list)
+    for recipient, indexes in routed.items():
+        recipient_errors[recipient].extend(errors[i] for i in sorted(indexes))
+    
+    # Senza match: differenza tra tutti gli indici e quelli assegnati
+    unmatched = sorted(set(range(len(errors))) - matched)
+    unmatched_errors = [errors[i] for i in unmatched]
+    undelivered = len(unmatched_errors)
     
     # Gestisci errori senza match
     if unmatched_errors:
         if query.routing_no_match_action == 'send_default':
-            default_recipients = query.get_default_routing_recipients()
+            default_recipients = _recipients_tuple(query.routing_default_recipients)
             for recipient in default_recipients:
                 recipient_errors[recipient].extend(unmatched_errors)
+            if default_recipients:
+                undelivered = 0
         # else: 'skip' - non fare nulla, errori persi (ma loggati)
         
         if unmatched_errors and query.routing_no_match_action == 'skip':
@@ -266,7 +895,23 @@ def apply_routing_rules(query: MonitoredQuery, errors: list) -> dict:
                 f"Query {query.name}: {len(unmatched_errors)} errori senza match routing (skipped)"
             )
     
-    return dict(recipient_errors)
+    return dict(recipient_errors), undelivered
+
+
+def apply_routing_rules(query: MonitoredQuery, errors: list) -> dict:
+    """
+    Applica le regole di routing e raggruppa gli errori per destinatario.
+    
+    Args:
+        query: MonitoredQuery con le regole configurate
+        errors: lista di dizionari con i dati degli errori
+        
+    Returns:
+        dict: {recipient: [errors]} 
+              - Se routing disabilitato: {tuple(recipients): all_errors}
+              - Se routing abilitato: {recipient1: [err1, err3], recipient2: [err2], ...}
+    """
+    return _route_errors(query, errors)[0]
 
 
 def get_routing_summary(query: MonitoredQuery, errors: list) -> dict:
@@ -281,7 +926,18 @@ def get_routing_summary(query: MonitoredQuery, errors: list) -> dict:
             'unmatched': int
         }
     """
-    routing_result = apply_routing_rules(query, errors)
+    return route_with_summary(query, errors)[1]
+
+
+def route_with_summary(query: MonitoredQuery, errors: list) -> tuple:
+    """
+    Routing e relativo riepilogo con una sola valutazione delle regole,
+    per chi ha bisogno di entrambi (es. test del routing da UI).
+    
+    Returns:
+        tuple: (apply_routing_rules(query, errors), get_routing_summary(query, errors))
+    """
+    routing_result, undelivered = _route_errors(query, errors)
     
     summary = {
         'total_errors': len(errors),
@@ -290,26 +946,17 @@ def get_routing_summary(query: MonitoredQuery, errors: list) -> dict:
         'unmatched': 0
     }
     
-    if not query.routing_enabled:
-        recipients = query.get_recipients_list()
-        for r in recipients:
-            summary['recipients'][r] = len(errors)
-    else:
-        for recipient, recipient_errors in routing_result.items():
-            if isinstance(recipient, tuple):
-                for r in recipient:
-                    summary['recipients'][r] = len(recipient_errors)
-            else:
-                summary['recipients'][recipient] = len(recipient_errors)
-        
-        # Calcola unmatched
-        matched_errors = set()
-        for errs in routing_result.values():
-            for e in errs:
-                matched_errors.add(id(e))
-        summary['unmatched'] = len(errors) - len(matched_errors)
-    
-    return summary
+    for recipient, recipient_errors in routing_result.items():
+        if isinstance(recipient, tuple):
+            for r in recipient:
+                summary['recipients'][r] = len(recipient_errors)
+        else:
+            summary['recipients'][recipient] = len(recipient_errors)
+    
+    # Errori che non finiscono in nessuna lista
+    summary['unmatched'] = undelivered
+    
+    return routing_result, summary
 
 
 def get_operators_list():
@@ -54,6 +54,9 @@ def init_scheduler(app):
                             
                 except Exception as e:
                     logger.error(f"Scheduler: eccezione in {query.name}: {e}")
+            
+            # Scrive i log di esecuzione accumulati nel ciclo
+            monitor_service.flush_logs()
 
     @scheduler.task('cron', id='cleanup_old_records', hour=3, minute=0, misfire_grace_time=3600)
     def cleanup_old_records():
@@ -9,6 +9,8 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from datetime import timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker
 from app import create_app
 from models import (db, MonitoredQuery, RoutingRule, RoutingCondition,
                     ErrorRecord, QueryLog, EmailLog, DatabaseConnection,
@@ -16,16 +18,55 @@ from models import (db, MonitoredQuery, RoutingRule, RoutingCondition,
 from utils import get_utc_now
 
 
-@pytest.fixture(scope='function')
-def app():
-    """Crea un'istanza dell'applicazione per i test."""
+@pytest.fixture(scope='session')
+def _app():
+    """Crea l'applicazione e lo schema una sola volta per l'intera sessione."""
     app = create_app('testing')
     
     with app.app_context():
+        # pysqlite gestisce male i SAVEPOINT: disattiva il suo BEGIN implicito
+        # su ogni connessione del pool e lascia che sia SQLAlchemy a emettere
+        # BEGIN esplicitamente
+        engine = db.engine
+        
+        @event.listens_for(engine, 'connect')
+        def _do_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+        
+        @event.listens_for(engine, 'begin')
+        def _do_begin(conn):
+            conn.exec_driver_sql('BEGIN')
+        
+        # Le connessioni aperte da create_app non passano dal listener:
+        # chiude il pool e ricrea lo schema su connessioni nuove
+        engine.dispose()
         db.create_all()
-        yield app
-        db.session.remove()
-        db.drop_all()
+    
+    yield app
+
+
+@pytest.fixture(scope='function')
+def app(_app):
+    """
+    Isola ogni test in una transazione esterna annullata al termine.
+    I commit dei test rilasciano solo SAVEPOINT, lo schema resta intatto.
+    """
+    with _app.app_context():
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        
+        original_session = db.session
+        db.session = scoped_session(
+            sessionmaker(bind=connection, join_transaction_mode='create_savepoint'),
+            scopefunc=original_session.registry.scopefunc
+        )
+        try:
+            yield _app
+        finally:
+            db.session.remove()
+            db.session = original_session
+            transaction.rollback()
+            connection.close()
 
 
 @pytest.fixture(scope='function')
@@ -1,9 +1,11 @@
 """
 Test per i modelli: scheduling, hash, needs_reminder, serializzazione.
 """
+import json
 import pytest
 from datetime import datetime, time, timedelta
-from models import db, MonitoredQuery, ErrorRecord, DatabaseConnection
+from unittest.mock import patch
+from models import db, MonitoredQuery, ErrorRecord, DatabaseConnection, create_missing_indexes
 
 
 class TestErrorHash:
@@ -86,6 +88,45 @@ class TestErrorDataSerialization:
             result = e.get_error_data()
             assert result['NAME'] == 'Pescimoro à è ì ò ù'
             assert result['DESC'] == '日本語'
+    
+    def test_decoded_data_cached_until_changed(self, app):
+        """get_error_data decodifica una volta sola finché error_data non cambia."""
+        with app.app_context():
+            e = ErrorRecord(query_id=1, error_hash='test')
+            e.set_error_data({'ID': '001'})
+            with patch('models.json.loads', wraps=json.loads) as loads:
+                assert e.get_error_data() == e.get_error_data() == {'ID': '001'}
+            assert loads.call_count == 1
+            
+            e.set_error_data({'ID': '002'})
+            assert e.get_error_data()['ID'] == '002'
+    
+    def test_returned_data_is_a_copy(self, app):
+        """Modificare il dict restituito non cambia le letture successive."""
+        with app.app_context():
+            e = ErrorRecord(query_id=1, error_hash='test')
+            e.set_error_data({'ID': '001'})
+            
+            data = e.get_error_data()
+            data['ID'] = 'changed'
+            data['EXTRA'] = 'x'
+            
+            assert e.get_error_data() == {'ID': '001'}
+
+
+class TestActiveErrorCount:
+    """Test per ErrorRecord.active_error_count."""
+    
+    def test_counts_only_active(self, app, sample_query, sample_errors_in_db):
+        """Conta solo gli errori non risolti."""
+        with app.app_context():
+            assert ErrorRecord.active_error_count(sample_query.id) == 2
+    
+    def test_cap_limits_count(self, app, sample_query, sample_errors_in_db):
+        """Con cap il conteggio non supera il limite."""
+        with app.app_context():
+            assert ErrorRecord.active_error_count(sample_query.id, cap=1) == 1
+            assert ErrorRecord.active_error_count(sample_query.id, cap=3) == 2
 
 
 class TestNeedsReminder:
@@ -294,3 +335,28 @@ class TestKeyFieldsList:
             query = MonitoredQuery.query.get(sample_query.id)
             query.key_fields = '  ID  ,  CODE  '
             assert query.get_key_fields_list() == ['ID', 'CODE']
+
+
+class TestCreateMissingIndexes:
+    """Test per create_missing_indexes su database già esistenti."""
+    
+    def test_adds_index_to_existing_table(self):
+        """Un indice assente su una tabella esistente viene creato."""
+        from sqlalchemy import create_engine, inspect
+        
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.exec_driver_sql('DROP INDEX ix_error_active')
+        
+        create_missing_indexes(engine)
+        # Seconda chiamata: gli indici esistono già, nessun errore
+        create_missing_indexes(engine)
+        
+        indexes = {i['name'] for i in inspect(engine).get_indexes('error_records')}
+        assert {'ix_error_active', 'ix_error_query_hash'} <= indexes
+        with engine.connect() as conn:
+            sql = conn.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE name = 'ix_error_active'"
+            ).scalar()
+        assert 'WHERE resolved_at IS NULL' in sql
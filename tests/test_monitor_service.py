@@ -2,189 +2,145 @@
 Test per il monitor_service: check_query, deduplicazione, risoluzione errori.
 """
 import pytest
+from datetime import time, timedelta, datetime as dt
+from types import SimpleNamespace
 from unittest.mock import patch, MagicMock
 from models import db, MonitoredQuery, ErrorRecord, QueryLog
+from utils import get_utc_now
 
 
-class TestCheckQueryNewErrors:
-    """Test per il rilevamento di nuovi errori."""
-    
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_finds_new_errors(self, mock_execute, mock_email, app, sample_query):
-        """Trova nuovi errori e li salva nel database."""
-        with app.app_context():
-            from monitor_service import monitor_service
-            
-            mock_execute.return_value = (
-                ['ID', 'CODE', 'MESSAGE'],
-                [
-                    {'ID': '001', 'CODE': 'ERR001', 'MESSAGE': 'Error 1'},
-                    {'ID': '002', 'CODE': 'ERR002', 'MESSAGE': 'Error 2'},
-                ]
-            )
-            mock_email.send_error_notification.return_value = {'success': True}
-            
-            query = MonitoredQuery.query.get(sample_query.id)
-            result = monitor_service.check_query(query, force=True)
-            
-            assert result['status'] == 'success'
-            assert result['rows_returned'] == 2
-            assert result['new_errors'] == 2
-            
-            # Verifica che gli errori siano stati salvati
-            errors = ErrorRecord.query.filter_by(query_id=query.id).all()
-            assert len(errors) == 2
-    
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_no_rows_no_errors(self, mock_execute, mock_email, app, sample_query):
-        """Nessuna riga restituita = nessun errore nuovo."""
-        with app.app_context():
-            from monitor_service import monitor_service
-            
-            mock_execute.return_value = (['ID', 'CODE'], [])
-            
-            query = MonitoredQuery.query.get(sample_query.id)
-            result = monitor_service.check_query(query, force=True)
-            
-            assert result['status'] == 'success'
-            assert result['rows_returned'] == 0
-            assert result['new_errors'] == 0
+# Risultati della sorgente dati condivisi tra i test (da non modificare)
+COLUMNS = ('ID', 'CODE', 'MESSAGE')
+ROW_001 = {'ID': '001', 'CODE': 'ERR001', 'MESSAGE': 'Error 1'}
+ROW_002 = {'ID': '002', 'CODE': 'ERR002', 'MESSAGE': 'Error 2'}
+ROWS_TWO = (COLUMNS, (ROW_001, ROW_002))
+ROWS_ONE = (COLUMNS, (ROW_001,))
+ROWS_NONE = (COLUMNS, ())
+
 
+@pytest.fixture(autouse=True)
+def _mocks(monkeypatch):
+    """Sostituisce sorgente dati ed email_service con mock per ogni test."""
+    mock_execute = MagicMock()
+    mock_email = MagicMock()
+    mock_email.send_error_notification.return_value = {'success': True}
+    monkeypatch.setattr('monitor_service.execute_query_source', mock_execute)
+    monkeypatch.setattr('monitor_service.email_service', mock_email)
+    return SimpleNamespace(execute=mock_execute, email=mock_email)
 
-class TestCheckQueryDeduplication:
-    """Test per la deduplicazione tramite hash."""
+
+class TestCheckQueryTwoRuns:
+    """
+    Nuovi errori, deduplicazione e risoluzione: due esecuzioni consecutive
+    con risultati diversi della sorgente dati.
+    """
     
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_duplicate_not_counted(self, mock_execute, mock_email, app, sample_query):
-        """Errore già presente non viene contato come nuovo."""
+    @pytest.mark.parametrize('first, second, expect_new, expect_resolved', [
+        pytest.param(ROWS_NONE, ROWS_TWO, 2, 0, id='finds_new_errors'),
+        pytest.param(ROWS_NONE, ROWS_NONE, 0, 0, id='no_rows_no_errors'),
+        pytest.param(ROWS_ONE, ROWS_ONE, 0, 0, id='duplicate_not_counted'),
+        pytest.param(ROWS_ONE, ROWS_TWO, 1, 0, id='new_alongside_existing'),
+        pytest.param(ROWS_TWO, ROWS_ONE, 0, 1, id='resolved_when_missing'),
+        pytest.param(ROWS_TWO, ROWS_NONE, 0, 2, id='all_errors_resolved'),
+    ])
+    def test_second_run(self, _mocks, app, sample_query,
+                        first, second, expect_new, expect_resolved):
+        """La seconda esecuzione conta nuovi/risolti e aggiorna gli errori attivi."""
         with app.app_context():
             from monitor_service import monitor_service
             
-            rows = [{'ID': '001', 'CODE': 'ERR001', 'MESSAGE': 'Error 1'}]
-            mock_execute.return_value = (['ID', 'CODE', 'MESSAGE'], rows)
-            mock_email.send_error_notification.return_value = {'success': True}
-            
             query = MonitoredQuery.query.get(sample_query.id)
             
-            # Prima esecuzione: trova 1 errore nuovo
+            # Prima esecuzione: tutte le righe sono nuove
+            _mocks.execute.return_value = first
             r1 = monitor_service.check_query(query, force=True)
-            assert r1['new_errors'] == 1
+            assert r1['new_errors'] == len(first[1])
             
             # Reset lock per rieseguire
             query.locked_at = None
             db.session.commit()
             
-            # Seconda esecuzione con stessi dati: 0 nuovi
+            _mocks.execute.return_value = second
             r2 = monitor_service.check_query(query, force=True)
-            assert r2['new_errors'] == 0
-            assert r2['rows_returned'] == 1
-    
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_occurrence_count_incremented(self, mock_execute, mock_email, app, sample_query):
-        """Errore visto di nuovo incrementa il contatore."""
-        with app.app_context():
-            from monitor_service import monitor_service
-            
-            rows = [{'ID': '001', 'CODE': 'ERR001', 'MESSAGE': 'Error 1'}]
-            mock_execute.return_value = (['ID', 'CODE', 'MESSAGE'], rows)
-            mock_email.send_error_notification.return_value = {'success': True}
-            
-            query = MonitoredQuery.query.get(sample_query.id)
             
-            # Prima esecuzione
-            monitor_service.check_query(query, force=True)
-            query.locked_at = None
-            db.session.commit()
+            assert r2['status'] == 'success'
+            assert r2['rows_returned'] == len(second[1])
+            assert r2['new_errors'] == expect_new
+            assert r2['resolved_errors'] == expect_resolved
             
-            # Seconda esecuzione
-            monitor_service.check_query(query, force=True)
-            
-            error = ErrorRecord.query.filter_by(query_id=query.id).first()
-            assert error.occurrence_count == 2
+            # Restano attivi solo gli errori della seconda esecuzione;
+            # quelli già presenti prima sono stati visti due volte
+            first_ids = {row['ID'] for row in first[1]}
+            active = ErrorRecord.query.filter_by(query_id=query.id, resolved_at=None).all()
+            assert sorted(e.get_error_data()['ID'] for e in active) == \
+                sorted(row['ID'] for row in second[1])
+            for error in active:
+                seen_before = error.get_error_data()['ID'] in first_ids
+                assert error.occurrence_count == (2 if seen_before else 1)
 
 
-class TestCheckQueryResolution:
-    """Test per la risoluzione automatica degli errori."""
+class TestCheckQueryReminders:
+    """Test per l'invio dei reminder su errori non risolti."""
     
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_error_resolved_when_missing(self, mock_execute, mock_email, app, sample_query):
-        """Errore non più presente nella query viene marcato come risolto."""
+    def _seed_error(self, query, row, email_sent_at, **kwargs):
+        error = ErrorRecord(
+            query_id=query.id,
+            error_hash=ErrorRecord.calculate_hash(row, query.get_key_fields_list()),
+            email_sent=True,
+            email_sent_at=email_sent_at,
+            **kwargs
+        )
+        error.set_error_data(row)
+        db.session.add(error)
+        db.session.commit()
+        return error
+    
+    def test_reminder_sent_and_counted(self, _mocks, app, sample_query):
+        """Errore con intervallo scaduto riceve un reminder e aggiorna i contatori."""
         with app.app_context():
             from monitor_service import monitor_service
             
-            mock_email.send_error_notification.return_value = {'success': True}
-            
             query = MonitoredQuery.query.get(sample_query.id)
+            query.reminder_enabled = True
+            query.reminder_interval_minutes = 60
+            error = self._seed_error(query, ROW_001, get_utc_now() - timedelta(hours=2))
             
-            # Prima esecuzione: 2 errori
-            mock_execute.return_value = (
-                ['ID', 'CODE'],
-                [
-                    {'ID': '001', 'CODE': 'ERR001'},
-                    {'ID': '002', 'CODE': 'ERR002'},
-                ]
-            )
-            monitor_service.check_query(query, force=True)
-            query.locked_at = None
-            db.session.commit()
-            
-            assert ErrorRecord.query.filter_by(query_id=query.id, resolved_at=None).count() == 2
-            
-            # Seconda esecuzione: solo 1 errore (002 risolto)
-            mock_execute.return_value = (
-                ['ID', 'CODE'],
-                [{'ID': '001', 'CODE': 'ERR001'}]
-            )
-            r2 = monitor_service.check_query(query, force=True)
-            
-            assert r2['resolved_errors'] == 1
+            _mocks.execute.return_value = ROWS_ONE
+            result = monitor_service.check_query(query, force=True)
             
-            active = ErrorRecord.query.filter_by(query_id=query.id, resolved_at=None).all()
-            assert len(active) == 1
-            assert active[0].get_error_data()['ID'] == '001'
+            assert result['reminders_sent'] == 1
+            db.session.refresh(error)
+            assert error.reminder_count == 1
+            assert error.last_reminder_at is not None
     
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_all_errors_resolved(self, mock_execute, mock_email, app, sample_query):
-        """Se la query non restituisce più righe, tutti gli errori vengono risolti."""
+    def test_reminder_not_due(self, _mocks, app, sample_query):
+        """Errori notificati di recente o al limite reminder vengono esclusi."""
         with app.app_context():
             from monitor_service import monitor_service
             
-            mock_email.send_error_notification.return_value = {'success': True}
-            
             query = MonitoredQuery.query.get(sample_query.id)
+            query.reminder_enabled = True
+            query.reminder_interval_minutes = 60
+            query.reminder_max_count = 2
+            # 001 notificato di recente, 002 al limite dei reminder
+            self._seed_error(query, ROW_001, get_utc_now() - timedelta(minutes=10))
+            self._seed_error(query, ROW_002, get_utc_now() - timedelta(hours=5),
+                             reminder_count=2)
+            
+            _mocks.execute.return_value = ROWS_TWO
+            result = monitor_service.check_query(query, force=True)
             
-            # Prima: 2 errori
-            mock_execute.return_value = (
-                ['ID', 'CODE'],
-                [{'ID': '001', 'CODE': 'ERR001'}, {'ID': '002', 'CODE': 'ERR002'}]
-            )
-            monitor_service.check_query(query, force=True)
-            query.locked_at = None
-            db.session.commit()
-            
-            # Dopo: 0 righe
-            mock_execute.return_value = (['ID', 'CODE'], [])
-            r2 = monitor_service.check_query(query, force=True)
-            
-            assert r2['resolved_errors'] == 2
-            assert ErrorRecord.query.filter_by(query_id=query.id, resolved_at=None).count() == 0
+            assert result['reminders_sent'] == 0
+            _mocks.email.send_error_notification.assert_not_called()
 
 
 class TestCheckQuerySchedule:
     """Test per il rispetto della fascia oraria."""
     
-    @patch('monitor_service.execute_query_source')
-    def test_skips_out_of_schedule(self, mock_execute, app, sample_query):
+    def test_skips_out_of_schedule(self, _mocks, app, sample_query):
         """Query fuori fascia oraria viene skippata se non force."""
         with app.app_context():
             from monitor_service import monitor_service
-            from datetime import time
             
             query = MonitoredQuery.query.get(sample_query.id)
             query.schedule_start_time = time(8, 0)
@@ -193,45 +149,40 @@ class TestCheckQuerySchedule:
             
             # Mock _get_local_now per simulare orario fuori fascia
             with patch.object(query, '_get_local_now') as mock_now:
-                from datetime import datetime as dt
                 mock_now.return_value = dt(2025, 2, 10, 22, 0, 0)
                 
                 result = monitor_service.check_query(query, force=False)
             
             assert result['status'] == 'skipped'
-            mock_execute.assert_not_called()
+            _mocks.execute.assert_not_called()
     
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_force_ignores_schedule(self, mock_execute, mock_email, app, sample_query):
+    def test_force_ignores_schedule(self, _mocks, app, sample_query):
         """Con force=True la fascia oraria viene ignorata."""
         with app.app_context():
             from monitor_service import monitor_service
-            from datetime import time
             
             query = MonitoredQuery.query.get(sample_query.id)
             query.schedule_start_time = time(8, 0)
             query.schedule_end_time = time(10, 0)
             db.session.commit()
             
-            mock_execute.return_value = (['ID'], [])
+            _mocks.execute.return_value = ROWS_NONE
             
             result = monitor_service.check_query(query, force=True)
             
             assert result['status'] == 'success'
-            mock_execute.assert_called_once()
+            _mocks.execute.assert_called_once()
 
 
 class TestCheckQueryErrorHandling:
     """Test per la gestione errori durante l'esecuzione."""
     
-    @patch('monitor_service.execute_query_source')
-    def test_data_source_error(self, mock_execute, app, sample_query):
+    def test_data_source_error(self, _mocks, app, sample_query):
         """Errore nella sorgente dati viene gestito e loggato."""
         with app.app_context():
             from monitor_service import monitor_service
             
-            mock_execute.side_effect = Exception("Connection refused")
+            _mocks.execute.side_effect = Exception("Connection refused")
             
             query = MonitoredQuery.query.get(sample_query.id)
             result = monitor_service.check_query(query, force=True)
@@ -243,18 +194,12 @@ class TestCheckQueryErrorHandling:
 class TestCheckQueryStats:
     """Test per l'aggiornamento delle statistiche."""
     
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_updates_query_stats(self, mock_execute, mock_email, app, sample_query):
+    def test_updates_query_stats(self, _mocks, app, sample_query):
         """check_query aggiorna last_check_at e contatori."""
         with app.app_context():
             from monitor_service import monitor_service
             
-            mock_execute.return_value = (
-                ['ID', 'CODE'],
-                [{'ID': '001', 'CODE': 'ERR001'}]
-            )
-            mock_email.send_error_notification.return_value = {'success': True}
+            _mocks.execute.return_value = ROWS_ONE
             
             query = MonitoredQuery.query.get(sample_query.id)
             assert query.last_check_at is None
@@ -267,15 +212,12 @@ class TestCheckQueryStats:
             assert query.last_check_at is not None
             assert query.total_errors_found == 1
     
-    @patch('monitor_service.email_service')
-    @patch('monitor_service.execute_query_source')
-    def test_creates_execution_log(self, mock_execute, mock_email, app, sample_query):
+    def test_creates_execution_log(self, _mocks, app, sample_query):
         """check_query crea un QueryLog per ogni esecuzione."""
         with app.app_context():
             from monitor_service import monitor_service
             
-            mock_execute.return_value = (['ID'], [{'ID': '001'}])
-            mock_email.send_error_notification.return_value = {'success': True}
+            _mocks.execute.return_value = ROWS_ONE
             
             query = MonitoredQuery.query.get(sample_query.id)
             monitor_service.check_query(query, force=True)
@@ -286,6 +228,102 @@ class TestCheckQueryStats:
             assert log.rows_returned == 1
             assert log.new_errors == 1
             assert log.execution_time_ms >= 0
+    
+    def test_execution_log_batched_until_flush(self, _mocks, monkeypatch, app, sample_query):
+        """Con batch > 1 i QueryLog dello scheduler restano in coda fino a flush_logs."""
+        with app.app_context():
+            from monitor_service import monitor_service
+            monkeypatch.setattr(monitor_service, 'log_batch_size', 3)
+            monkeypatch.setattr(MonitoredQuery, 'is_in_schedule', lambda self, now=None: True)
+            
+            _mocks.execute.return_value = ROWS_NONE
+            
+            query = MonitoredQuery.query.get(sample_query.id)
+            monitor_service.check_query(query)
+            
+            assert QueryLog.query.filter_by(query_id=query.id).count() == 0
+            
+            assert monitor_service.flush_logs() == 1
+            log = QueryLog.query.filter_by(query_id=query.id).first()
+            assert log.status == 'success'
+            assert log.executed_at is not None
+    
+    def test_forced_run_flushes_log(self, _mocks, monkeypatch, app, sample_query):
+        """Le esecuzioni manuali (force) scrivono subito il log anche con batch > 1."""
+        with app.app_context():
+            from monitor_service import monitor_service
+            monkeypatch.setattr(monitor_service, 'log_batch_size', 3)
+            
+            _mocks.execute.return_value = ROWS_NONE
+            
+            query = MonitoredQuery.query.get(sample_query.id)
+            monitor_service.check_query(query, force=True)
+            
+            assert QueryLog.query.filter_by(query_id=query.id).count() == 1
+    
+    def test_failed_flush_keeps_logs(self, _mocks, monkeypatch, app, sample_query):
+        """Se la scrittura fallisce i log restano in coda per il flush successivo."""
+        with app.app_context():
+            from monitor_service import monitor_service
+            monkeypatch.setattr(monitor_service, 'log_batch_size', 3)
+            monkeypatch.setattr(MonitoredQuery, 'is_in_schedule', lambda self, now=None: True)
+            
+            _mocks.execute.return_value = ROWS_NONE
+            
+            query = MonitoredQuery.query.get(sample_query.id)
+            monitor_service.check_query(query)
+            
+            with patch.object(db.session, 'bulk_insert_mappings', side_effect=Exception('locked')):
+                assert monitor_service.flush_logs() == 0
+            
+            assert monitor_service.flush_logs() == 1
+            assert QueryLog.query.filter_by(query_id=query.id).count() == 1
+    
+    def test_failing_row_does_not_block_logs(self, _mocks, monkeypatch, app, sample_query):
+        """Un log che fallisce sempre viene scartato senza bloccare gli altri."""
+        with app.app_context():
+            from monitor_service import monitor_service, MAX_LOG_FLUSH_ATTEMPTS
+            monkeypatch.setattr(monitor_service, 'log_batch_size', 10)
+            monkeypatch.setattr(MonitoredQuery, 'is_in_schedule', lambda self, now=None: True)
+            
+            _mocks.execute.return_value = ROWS_NONE
+            query = MonitoredQuery.query.get(sample_query.id)
+            
+            monitor_service.check_query(query)
+            # query_id obbligatorio: la riga fallisce a ogni tentativo
+            monitor_service._pending_logs.append(({'query_id': None, 'status': 'success'}, 0))
+            monitor_service.check_query(query)
+            
+            assert monitor_service.flush_logs() == 2
+            for _ in range(MAX_LOG_FLUSH_ATTEMPTS - 1):
+                assert len(monitor_service._pending_logs) == 1
+                assert monitor_service.flush_logs() == 0
+            assert len(monitor_service._pending_logs) == 0
+            
+            # I log successivi vengono scritti normalmente
+            monitor_service.check_query(query)
+            assert monitor_service.flush_logs() == 1
+            assert QueryLog.query.filter_by(query_id=query.id).count() == 3
+    
+    def test_requeue_on_full_queue_drops_oldest(self, monkeypatch, app):
+        """Con la coda piena, al reinserimento dopo un flush fallito si perdono i log più vecchi."""
+        with app.app_context():
+            from collections import deque
+            from monitor_service import monitor_service
+            queue = deque([({'status': 'A'}, 0), ({'status': 'B'}, 0)], maxlen=3)
+            monkeypatch.setattr(monitor_service, '_pending_logs', queue)
+            
+            def fail(mapper, rows):
+                # Altri thread accodano C e D durante il flush, riempiendo la coda
+                if not queue:
+                    queue.extend([({'status': 'C'}, 0), ({'status': 'D'}, 0)])
+                raise Exception('database is locked')
+            
+            with patch.object(db.session, 'bulk_insert_mappings', side_effect=fail):
+                assert monitor_service.flush_logs() == 0
+            
+            assert [row['status'] for row, _ in queue] == ['B', 'C', 'D']
+            assert [attempts for _, attempts in queue] == [1, 0, 0]
 
 
 class TestGetActiveErrors:
@@ -3,7 +3,10 @@ Test avanzati per il routing: stop_on_match, logica OR, no_match, priorità.
 """
 import pytest
 from models import db, MonitoredQuery, RoutingRule, RoutingCondition
-from routing_service import apply_routing_rules, evaluate_rule, evaluate_condition, get_routing_summary
+from routing_service import (
+    apply_routing_rules, evaluate_rule, evaluate_condition, get_routing_summary,
+    route_with_summary
+)
 
 
 class TestStopOnMatch:
@@ -414,3 +417,32 @@ class TestGetRoutingSummary:
             summary = get_routing_summary(query, errors)
             
             assert summary['unmatched'] == 1
+    
+    def test_route_with_summary(self, app, sample_query):
+        """Routing e riepilogo da una sola valutazione; i default contano come match."""
+        with app.app_context():
+            query = MonitoredQuery.query.get(sample_query.id)
+            query.routing_enabled = True
+            query.routing_no_match_action = 'send_default'
+            query.routing_default_recipients = 'default@example.com'
+            
+            rule = RoutingRule(
+                query_id=query.id, name='Critici',
+                condition_logic='AND', recipients='critical@example.com',
+                priority=0, is_active=True
+            )
+            db.session.add(rule)
+            db.session.flush()
+            db.session.add(RoutingCondition(
+                rule_id=rule.id, field_name='SEVERITY',
+                operator='equals', value='CRITICAL'
+            ))
+            db.session.commit()
+            
+            errors = [{'ID': '001', 'SEVERITY': 'CRITICAL'}, {'ID': '002', 'SEVERITY': 'INFO'}]
+            result, summary = route_with_summary(query, errors)
+            
+            assert result == apply_routing_rules(query, errors)
+            assert summary == get_routing_summary(query, errors)
+            assert summary['recipients'] == {'critical@example.com': 1, 'default@example.com': 1}
+            assert summary['unmatched'] == 0
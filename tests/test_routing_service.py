@@ -4,9 +4,10 @@ Test per il modulo routing_service.
 import pytest
 from routing_service import (
     evaluate_condition, evaluate_rule, apply_routing_rules,
-    get_field_value, get_operators_list, OPERATORS
+    get_field_value, field_key_map, get_operators_list, load_routing_program,
+    OPERATORS
 )
-from models import RoutingCondition, RoutingRule, MonitoredQuery
+from models import db, RoutingCondition, RoutingRule, MonitoredQuery
 
 
 class TestGetFieldValue:
@@ -24,6 +25,13 @@ class TestGetFieldValue:
     def test_not_found(self):
         error = {'STATUS': 'ERROR'}
         assert get_field_value(error, 'MISSING') is None
+    
+    def test_with_key_map(self):
+        error = {'Status': 'ERROR', 'CODE': '001'}
+        key_map = field_key_map(error)
+        assert get_field_value(error, 'status', key_map) == 'ERROR'
+        assert get_field_value(error, 'code', key_map) == '001'
+        assert get_field_value(error, 'MISSING', key_map) is None
 
 
 class TestOperators:
@@ -172,3 +180,178 @@ class TestApplyRoutingRules:
             warning_errors = result['warning@example.com']
             assert len(warning_errors) == 1
             assert warning_errors[0]['SEVERITY'] == 'WARNING'
+    
+    def test_numeric_range_rule(self, app, sample_query):
+        """Condizioni numeriche sullo stesso campo (range) e valori non numerici."""
+        with app.app_context():
+            query = MonitoredQuery.query.get(sample_query.id)
+            query.routing_enabled = True
+            query.routing_no_match_action = 'skip'
+            
+            rule = RoutingRule(query_id=query.id, name='Range', condition_logic='AND',
+                               recipients='range@example.com', priority=0, is_active=True)
+            db.session.add(rule)
+            db.session.flush()
+            db.session.add_all([
+                RoutingCondition(rule_id=rule.id, field_name='AMOUNT', operator='gte', value='10'),
+                RoutingCondition(rule_id=rule.id, field_name='amount', operator='lt', value='100'),
+            ])
+            db.session.commit()
+            
+            errors = [
+                {'ID': '1', 'AMOUNT': '5'},
+                {'ID': '2', 'AMOUNT': '10'},
+                {'ID': '3', 'AMOUNT': 99.5},
+                {'ID': '4', 'AMOUNT': '100'},
+                {'ID': '5', 'AMOUNT': 'n/a'},
+                {'ID': '6'},
+            ]
+            
+            result = apply_routing_rules(query, errors)
+            
+            assert [e['ID'] for e in result['range@example.com']] == ['2', '3']
+    
+    def test_or_rule_many_regex(self, app, sample_query):
+        """
+        Regola OR con molte regex sullo stesso campo (valutate come alternanza).
+        Un pattern non valido da solo ('a)|(b') non corrisponde mai.
+        """
+        with app.app_context():
+            query = MonitoredQuery.query.get(sample_query.id)
+            query.routing_enabled = True
+            query.routing_no_match_action = 'skip'
+            
+            rule = RoutingRule(query_id=query.id, name='Codici', condition_logic='OR',
+                               recipients='codes@example.com', priority=0, is_active=True)
+            db.session.add(rule)
+            db.session.flush()
+            db.session.add_all([
+                RoutingCondition(rule_id=rule.id, field_name='CODE', operator='regex', value=pattern)
+                for pattern in ('^DB', 'TIMEOUT$', r'E\d{3}', '(a|b)c', r'(x)\1', 'a)|(b')
+            ])
+            db.session.commit()
+            
+            errors = [
+                {'ID': '1', 'CODE': 'db_lock'},
+                {'ID': '2', 'CODE': 'NET TIMEOUT'},
+                {'ID': '3', 'CODE': 'E042'},
+                {'ID': '4', 'CODE': 'xx'},
+                {'ID': '5', 'CODE': 'OK'},
+                {'ID': '6', 'CODE': None},
+                {'ID': '7', 'CODE': 'b'},
+            ]
+            
+            result = apply_routing_rules(query, errors)
+            
+            assert [e['ID'] for e in result['codes@example.com']] == ['1', '2', '3', '4']
+    
+    def test_program_cache_follows_rule_changes(self, app, sample_query_with_routing):
+        """Il programma compilato è riusato finché le regole non cambiano."""
+        with app.app_context():
+            query = MonitoredQuery.query.get(sample_query_with_routing.id)
+            
+            program = load_routing_program(query)
+            assert load_routing_program(query) is program
+            
+            cond = RoutingCondition.query.filter_by(value='CRITICAL').first()
+            cond.value = 'FATAL'
+            db.session.commit()
+            
+            assert load_routing_program(query) is not program
+            result = apply_routing_rules(query, [{'ID': '1', 'SEVERITY': 'FATAL'}])
+            assert 'critical@example.com' in result
+    
+    def test_recipients_case_insensitive(self, app, sample_query):
+        """Lo stesso indirizzo scritto con maiuscole diverse è un solo destinatario."""
+        with app.app_context():
+            query = MonitoredQuery.query.get(sample_query.id)
+            query.routing_enabled = True
+            query.routing_default_recipients = 'Default@Example.com, default@example.com'
+            
+            for priority, recipients in enumerate(['Ops@Example.com', 'ops@example.com, dba@example.com']):
+                rule = RoutingRule(query_id=query.id, condition_logic='AND', recipients=recipients,
+                                   priority=priority, is_active=True)
+                db.session.add(rule)
+                db.session.flush()
+                db.session.add(RoutingCondition(rule_id=rule.id, field_name='STATUS',
+                                                operator='equals', value='ERROR'))
+            db.session.commit()
+            
+            errors = [{'ID': '1', 'STATUS': 'ERROR'}, {'ID': '2', 'STATUS': 'OK'}]
+            result = apply_routing_rules(query, errors)
+            
+            assert set(result) == {'ops@example.com', 'dba@example.com', 'default@example.com'}
+            assert [e['ID'] for e in result['ops@example.com']] == ['1']
+            assert [e['ID'] for e in result['default@example.com']] == ['2']
+    
+    def test_compiled_rule_recipients(self, app, sample_query_with_routing):
+        """I destinatari sono separati e normalizzati una volta, alla compilazione."""
+        with app.app_context():
+            query = MonitoredQuery.query.get(sample_query_with_routing.id)
+            rule = RoutingRule.query.filter_by(query_id=query.id, priority=0).first()
+            rule.recipients = ' Critical@Example.com , oncall@example.com,, '
+            db.session.commit()
+            
+            compiled = load_routing_program(query)[0]
+            assert compiled.recipients == ('critical@example.com', 'oncall@example.com')
+            assert load_routing_program(query)[0].recipients is compiled.recipients
+    
+    def test_and_rule_short_circuit(self, app, sample_query, monkeypatch):
+        """Le regex vengono valutate dopo equals e solo sugli errori ancora in gioco."""
+        import routing_service
+        
+        with app.app_context():
+            query = MonitoredQuery.query.get(sample_query.id)
+            query.routing_enabled = True
+            query.routing_no_match_action = 'skip'
+            
+            rule = RoutingRule(query_id=query.id, name='Critici DB', condition_logic='AND',
+                               recipients='db@example.com', priority=0, is_active=True)
+            db.session.add(rule)
+            db.session.flush()
+            db.session.add_all([
+                RoutingCondition(rule_id=rule.id, field_name='CODE', operator='regex', value='^DB'),
+                RoutingCondition(rule_id=rule.id, field_name='SEVERITY', operator='equals',
+                                 value='CRITICAL'),
+            ])
+            db.session.commit()
+            
+            evaluated = []
+            condition_mask = routing_service._condition_mask
+            
+            def spy(predicate, values):
+                evaluated.extend(values)
+                return condition_mask(predicate, values)
+            
+            monkeypatch.setattr(routing_service, '_condition_mask', spy)
+            
+            errors = [
+                {'ID': '1', 'CODE': 'DB_LOCK', 'SEVERITY': 'CRITICAL'},
+                {'ID': '2', 'CODE': 'DB_LOCK', 'SEVERITY': 'INFO'},
+                {'ID': '3', 'CODE': 'NET', 'SEVERITY': 'INFO'},
+            ]
+            
+            result = apply_routing_rules(query, errors)
+            
+            assert [e['ID'] for e in result['db@example.com']] == ['1']
+            assert evaluated == ['DB_LOCK']
+    
+    def test_program_cache_bounded(self, app, sample_query_with_routing, monkeypatch):
+        """La cache dei programmi è una LRU limitata; le query eliminate vengono rimosse."""
+        import routing_service
+        
+        with app.app_context():
+            monkeypatch.setattr(routing_service, '_program_cache', type(routing_service._program_cache)())
+            monkeypatch.setattr(routing_service, 'PROGRAM_CACHE_MAX', 1)
+            
+            other = MonitoredQuery(name='Other', source_type='oracle', sql_query='SELECT 1',
+                                   key_fields='ID', email_recipients='a@example.com')
+            db.session.add(other)
+            db.session.commit()
+            
+            load_routing_program(sample_query_with_routing)
+            load_routing_program(other)
+            assert list(routing_service._program_cache) == [other.id]
+            
+            routing_service.forget_routing_program(other.id)
+            assert not routing_service._program_cache
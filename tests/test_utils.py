@@ -0,0 +1,46 @@
+"""
+Test per utils: timezone fissata all'avvio o risolta a ogni richiesta.
+"""
+import pytest
+import utils
+from utils import freeze_timezone, get_configured_timezone
+
+
+@pytest.fixture
+def tz_app(app, monkeypatch):
+    """App con TIMEZONE configurabile; lo stato della timezone viene ripristinato."""
+    monkeypatch.setattr(utils, '_frozen_tz', utils._frozen_tz)
+    monkeypatch.setitem(app.config, 'TIMEZONE', 'Europe/Rome')
+    monkeypatch.setitem(app.config, 'TIMEZONE_PER_REQUEST', False)
+    return app
+
+
+class TestFreezeTimezone:
+    """Test per freeze_timezone e get_configured_timezone."""
+    
+    def test_frozen_by_default(self, tz_app):
+        """Di default la timezone resta quella dell'avvio anche se la config cambia."""
+        assert str(freeze_timezone(tz_app)) == 'Europe/Rome'
+        
+        with tz_app.app_context():
+            tz_app.config['TIMEZONE'] = 'Asia/Tokyo'
+            assert str(get_configured_timezone()) == 'Europe/Rome'
+    
+    def test_per_request_follows_config(self, tz_app):
+        """Con TIMEZONE_PER_REQUEST la config aggiornata viene letta e servita dalla cache."""
+        tz_app.config['TIMEZONE_PER_REQUEST'] = True
+        freeze_timezone(tz_app)
+        
+        with tz_app.app_context():
+            tz_app.config['TIMEZONE'] = 'Asia/Tokyo'
+            tokyo = get_configured_timezone()
+            assert str(tokyo) == 'Asia/Tokyo'
+            
+            hits = utils._resolve_timezone.cache_info().hits
+            assert get_configured_timezone() is tokyo
+            assert utils._resolve_timezone.cache_info().hits == hits + 1
+    
+    def test_invalid_name_falls_back_to_utc(self, tz_app):
+        """Un nome non valido diventa UTC."""
+        tz_app.config['TIMEZONE'] = 'Not/AZone'
+        assert str(freeze_timezone(tz_app)) == 'UTC'
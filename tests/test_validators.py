@@ -36,6 +36,11 @@ class TestValidateEmail:
         is_valid, error = validate_email(long_email)
         assert is_valid is False
         assert 'lunga' in error.lower()
+    
+    def test_local_part_too_long(self):
+        is_valid, error = validate_email('a' * 65 + '@example.com')
+        assert is_valid is False
+        assert 'formato' in error.lower()
 
 
 class TestValidateEmailList:
@@ -136,6 +141,16 @@ class TestValidateSqlQuery:
     def test_dangerous_pattern_delete(self):
         is_valid, error = validate_sql_query('SELECT * FROM users; DELETE FROM users')
         assert is_valid is False
+    
+    @pytest.mark.parametrize('sql', [
+        'SELECT * FROM users; truncate table users',
+        'SELECT * FROM users -- commento',
+        'SELECT * FROM users /* commento */',
+        'SELECT * FROM users /* commento\n su più righe */',
+    ])
+    def test_dangerous_patterns(self, sql):
+        is_valid, error = validate_sql_query(sql)
+        assert is_valid is False
 
 
 class TestValidateInterval:
@@ -206,6 +221,47 @@ class TestValidateRoutingRule:
         }
         is_valid, error = validate_routing_rule(data)
         assert is_valid is False
+    
+    def test_invalid_recipient(self):
+        data = {
+            'recipients': 'test@example.com, not-an-email',
+            'condition_logic': 'AND'
+        }
+        is_valid, error = validate_routing_rule(data)
+        assert is_valid is False
+        assert 'not-an-email' in error
+    
+    @pytest.mark.parametrize('conditions, message', [
+        ([{'field_name': 'STATUS', 'operator': 'equals'}, {'operator': 'equals'}],
+         'Condizione 2: campo obbligatorio'),
+        ([{'field_name': 'STATUS'}], 'Condizione 1: operatore obbligatorio'),
+    ])
+    def test_incomplete_condition(self, conditions, message):
+        data = {
+            'recipients': 'test@example.com',
+            'conditions': conditions
+        }
+        is_valid, error = validate_routing_rule(data)
+        assert is_valid is False
+        assert error == message
+    
+    def test_conditions_as_objects(self):
+        from types import SimpleNamespace
+        data = {
+            'recipients': 'test@example.com',
+            'conditions': [SimpleNamespace(field_name='STATUS', operator='')]
+        }
+        is_valid, error = validate_routing_rule(data)
+        assert is_valid is False
+        assert error == 'Condizione 1: operatore obbligatorio'
+    
+    def test_logic_not_a_string(self):
+        data = {
+            'recipients': 'test@example.com',
+            'condition_logic': ['AND']
+        }
+        is_valid, error = validate_routing_rule(data)
+        assert is_valid is False
 
 
 class TestValidateUrl:
@@ -243,6 +299,10 @@ class TestSanitizeString:
         result = sanitize_string('a' * 1000, max_length=100)
         assert len(result) == 100
     
+    def test_max_length_after_strip(self):
+        result = sanitize_string('   ' + 'a' * 99 + ' b', max_length=100)
+        assert result == 'a' * 99
+    
     def test_empty_string(self):
         result = sanitize_string('')
         assert result == ''
@@ -250,3 +310,11 @@ class TestSanitizeString:
     def test_none(self):
         result = sanitize_string(None)
         assert result == ''
+    
+    def test_control_chars_removed(self):
+        result = sanitize_string('a\x00b\x1bc\nd\te\x7f')
+        assert result == 'abc\nd\te\x7f'
+    
+    def test_control_chars_removed_non_ascii(self):
+        result = sanitize_string('caffè\x00 città\x1f')
+        assert result == 'caffè città'
@@ -3,11 +3,61 @@ Utility functions for ErrorEngine.
 Centralized timezone handling that works everywhere (with or without Flask context).
 """
 import os
+from functools import lru_cache
 from datetime import datetime, timezone, time, timedelta
 
-# Cache per evitare lookup ripetuti
-_cached_tz = None
-_cached_tz_name = None
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    from backports.zoneinfo import ZoneInfo
+
+try:
+    from flask import current_app
+except ImportError:
+    current_app = None
+
+# Timezone fissata all'avvio (vedi freeze_timezone), None se non fissata
+_frozen_tz = None
+
+
+# Cache per nome timezone: evita di ricostruire ZoneInfo (parsing tzdata)
+# quando TIMEZONE cambia tra richieste. Serve solo se la timezone non è
+# fissata (script senza app, o app con TIMEZONE_PER_REQUEST).
+# lru_cache è thread-safe: le richieste concorrenti non si intralciano
+@lru_cache(maxsize=16)
+def _resolve_timezone(tz_name):
+    """Returns the ZoneInfo for tz_name (UTC if invalid), memoized by name."""
+    try:
+        return ZoneInfo(tz_name)
+    except Exception:
+        return ZoneInfo('UTC')
+
+
+def freeze_timezone(app=None):
+    """
+    Resolves the configured timezone once and freezes it: later calls to
+    get_configured_timezone return it without looking up
+    current_app or the environment. Call at startup, after config is loaded.
+    
+    With app.config['TIMEZONE_PER_REQUEST'] set, the timezone is not frozen
+    and every call resolves it again through the bounded cache.
+    
+    Args:
+        app: Flask app to read TIMEZONE from (default: environment)
+    
+    Returns:
+        ZoneInfo: the configured timezone
+    """
+    global _frozen_tz
+    
+    tz_name = app.config.get('TIMEZONE') if app is not None else None
+    tz = _resolve_timezone(tz_name or os.environ.get('TIMEZONE', 'UTC'))
+    
+    if app is not None and app.config.get('TIMEZONE_PER_REQUEST'):
+        _frozen_tz = None
+    else:
+        _frozen_tz = tz
+    return tz
 
 
 def get_configured_timezone():
@@ -19,42 +69,30 @@ def get_configured_timezone():
     1. Flask current_app.config['TIMEZONE']
     2. os.environ['TIMEZONE']
     3. 'UTC' (fallback)
-    """
-    global _cached_tz, _cached_tz_name
     
-    try:
-        from zoneinfo import ZoneInfo
-    except ImportError:
-        from backports.zoneinfo import ZoneInfo
+    After freeze_timezone() the frozen timezone is returned directly,
+    unless TIMEZONE_PER_REQUEST is set.
+    """
+    # Timezone fissata all'avvio: nessun lookup
+    if _frozen_tz is not None:
+        return _frozen_tz
     
     # Determina timezone name
     tz_name = None
     
     # Prova Flask context
-    try:
-        from flask import current_app
-        if current_app and current_app.config:
-            tz_name = current_app.config.get('TIMEZONE')
-    except RuntimeError:
-        pass  # Fuori dal context Flask
+    if current_app is not None:
+        try:
+            if current_app and current_app.config:
+                tz_name = current_app.config.get('TIMEZONE')
+        except RuntimeError:
+            pass  # Fuori dal context Flask
     
     # Fallback a environment
     if not tz_name:
         tz_name = os.environ.get('TIMEZONE', 'UTC')
     
-    # Usa cache se timezone non è cambiata
-    if tz_name == _cached_tz_name and _cached_tz is not None:
-        return _cached_tz
-    
-    # Crea ZoneInfo
-    try:
-        _cached_tz = ZoneInfo(tz_name)
-        _cached_tz_name = tz_name
-    except Exception:
-        _cached_tz = ZoneInfo('UTC')
-        _cached_tz_name = 'UTC'
-    
-    return _cached_tz
+    return _resolve_timezone(tz_name)
 
 
 def get_local_now():
@@ -65,8 +103,7 @@ def get_local_now():
     Returns:
         datetime: Local time without tzinfo (naive local)
     """
-    tz = get_configured_timezone()
-    return datetime.now(timezone.utc).astimezone(tz).replace(tzinfo=None)
+    return datetime.now(get_configured_timezone()).replace(tzinfo=None)
 
 
 def get_utc_now():
@@ -154,8 +191,7 @@ def get_local_now_aware(app=None):
     Returns:
         datetime: Local time with tzinfo (aware)
     """
-    tz = get_configured_timezone()
-    return datetime.now(timezone.utc).astimezone(tz)
+    return datetime.now(get_configured_timezone())
 
 
 def format_local_now(fmt='%d/%m/%Y %H:%M:%S', app=None):
@@ -167,6 +203,6 @@ def format_local_now(fmt='%d/%m/%Y %H:%M:%S', app=None):
         app: Flask app (ignored, kept for compatibility)
     
     Returns:
-        str: Formatted local time
+        str: Formatted local time (%z/%Z give the local offset/zone)
     """
-    return get_local_now().strftime(fmt)
\ No newline at end of file
+    return datetime.now(get_configured_timezone()).strftime(fmt)
\ No newline at end of file
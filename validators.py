@@ -2,23 +2,48 @@
 Validators - Funzioni di validazione input per le API.
 """
 import re
+from functools import lru_cache
 from typing import Tuple, List, Optional
 
-# Pattern per email valida
-EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+# Pattern per email valida (da usare con fullmatch). Quantificatori limitati
+# (parte locale max 64 come da RFC) per tenere finito il backtracking
+EMAIL_PATTERN = re.compile(r'[a-zA-Z0-9._%+-]{1,64}@[a-zA-Z0-9.-]{1,190}\.[a-zA-Z]{2,24}')
 
-# Pattern per SQL injection basilare (non esaustivo, ma utile)
-SQL_DANGEROUS_PATTERNS = [
-    r';\s*DROP\s+',
-    r';\s*DELETE\s+',
-    r';\s*UPDATE\s+',
-    r';\s*INSERT\s+',
-    r';\s*ALTER\s+',
-    r';\s*CREATE\s+',
-    r';\s*TRUNCATE\s+',
-    r'--',
-    r'/\*.*\*/',
-]
+# Caratteri ammessi nel nome di una query (da usare con fullmatch)
+QUERY_NAME_PATTERN = re.compile(r'[\w\s\-]+')
+
+# Pattern per SQL injection basilare (non esaustivo, ma utile):
+# statement concatenati, commenti di riga e commenti a blocco (anche su più righe)
+_SQL_DANGEROUS = (
+    r';\s*(?:DROP|DELETE|UPDATE|INSERT|ALTER|CREATE|TRUNCATE)\s+'
+    r'|--'
+    r'|/\*.*?\*/'
+)
+
+# Con re2 (opzionale) il match è a tempo lineare anche su SQL costruito ad arte
+try:
+    import re2
+    SQL_DANGEROUS_RE = re2.compile(f'(?is){_SQL_DANGEROUS}')
+except ImportError:
+    SQL_DANGEROUS_RE = re.compile(_SQL_DANGEROUS, re.IGNORECASE | re.DOTALL)
+
+# Separatore delle liste separate da virgola, spazi attorno inclusi
+_CSV_SPLIT = re.compile(r'\s*,\s*')
+
+# Caratteri di controllo rimossi da sanitize_string (tranne \n, \r e \t)
+_CONTROL_CHARS = dict.fromkeys(i for i in range(32) if chr(i) not in '\n\r\t')
+# Stessi caratteri come byte, per il percorso veloce su input ASCII
+_CONTROL_BYTES = bytes(_CONTROL_CHARS)
+
+
+@lru_cache(maxsize=1024)
+def _email_matches(email: str) -> bool:
+    """
+    EMAIL_PATTERN.fullmatch memoizzato: le stesse liste di destinatari
+    vengono rivalidate spesso. Da chiamare dopo il controllo di lunghezza,
+    così in cache finiscono solo stringhe corte.
+    """
+    return EMAIL_PATTERN.fullmatch(email) is not None
 
 
 def validate_email(email: str) -> Tuple[bool, str]:
@@ -36,7 +61,7 @@ def validate_email(email: str) -> Tuple[bool, str]:
     if len(email) > 254:
         return False, "Email troppo lunga (max 254 caratteri)"
     
-    if not EMAIL_PATTERN.match(email):
+    if not _email_matches(email):
         return False, f"Formato email non valido: {email}"
     
     return True, ""
@@ -52,16 +77,17 @@ def validate_email_list(emails_str: str) -> Tuple[bool, str, List[str]]:
     if not emails_str:
         return True, "", []
     
-    emails = [e.strip() for e in emails_str.split(',') if e.strip()]
-    validated = []
+    emails = [e for e in _CSV_SPLIT.split(emails_str.strip()) if e]
     
-    for email in emails:
-        is_valid, error = validate_email(email)
-        if not is_valid:
-            return False, error, []
-        validated.append(email)
+    # Stessi controlli di validate_email, sulle email già strippate:
+    # il messaggio d'errore viene costruito solo per la prima non valida
+    bad = next((e for e in emails if len(e) > 254 or not _email_matches(e)), None)
+    if bad is not None:
+        if len(bad) > 254:
+            return False, "Email troppo lunga (max 254 caratteri)", []
+        return False, f"Formato email non valido: {bad}", []
     
-    return True, "", validated
+    return True, "", emails
 
 
 def validate_query_name(name: str) -> Tuple[bool, str]:
@@ -83,7 +109,7 @@ def validate_query_name(name: str) -> Tuple[bool, str]:
         return False, "Nome troppo lungo (massimo 100 caratteri)"
     
     # Solo caratteri alfanumerici, spazi, underscore e trattini
-    if not re.match(r'^[\w\s\-]+$', name, re.UNICODE):
+    if not QUERY_NAME_PATTERN.fullmatch(name):
         return False, "Nome contiene caratteri non validi"
     
     return True, ""
@@ -99,13 +125,14 @@ def validate_key_fields(key_fields: str) -> Tuple[bool, str, List[str]]:
     if not key_fields:
         return False, "Almeno un campo chiave è obbligatorio", []
     
-    fields = [f.strip() for f in key_fields.split(',') if f.strip()]
+    fields = [f for f in _CSV_SPLIT.split(key_fields.strip()) if f]
     
     if not fields:
         return False, "Almeno un campo chiave è obbligatorio", []
     
     for field in fields:
-        if not re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', field):
+        # Identificatore ASCII: lettera o underscore, poi lettere, cifre, underscore
+        if not field.isascii() or not field.isidentifier():
             return False, f"Campo chiave non valido: {field}", []
     
     return True, "", fields
@@ -127,15 +154,13 @@ def validate_sql_query(sql: str) -> Tuple[bool, str]:
     if len(sql) > 10000:
         return False, "Query troppo lunga (massimo 10000 caratteri)"
     
-    # Deve iniziare con SELECT
-    if not sql.upper().startswith('SELECT'):
+    # Deve iniziare con SELECT (maiuscolo solo sul prefisso, non su tutta la query)
+    if sql[:6].upper() != 'SELECT':
         return False, "La query deve essere una SELECT"
     
     # Controlla pattern pericolosi
-    sql_upper = sql.upper()
-    for pattern in SQL_DANGEROUS_PATTERNS:
-        if re.search(pattern, sql_upper, re.IGNORECASE):
-            return False, "Query contiene pattern non consentiti"
+    if SQL_DANGEROUS_RE.search(sql):
+        return False, "Query contiene pattern non consentiti"
     
     return True, ""
 
@@ -161,6 +186,10 @@ def validate_interval(value: int, min_val: int = 1, max_val: int = 1440) -> Tupl
     return True, ""
 
 
+# Valori ammessi per condition_logic di una regola di routing
+_VALID_LOGIC = frozenset({'AND', 'OR'})
+
+
 def validate_routing_rule(data: dict) -> Tuple[bool, str]:
     """
     Valida i dati di una regola di routing.
@@ -168,18 +197,18 @@ def validate_routing_rule(data: dict) -> Tuple[bool, str]:
     Returns:
         Tuple[bool, str]: (is_valid, error_message)
     """
-    # Recipients obbligatori
-    recipients = data.get('recipients', '')
+    # Recipients obbligatori: controllo del vuoto prima della validazione
+    recipients = (data.get('recipients') or '').strip()
+    if not recipients:
+        return False, "Almeno un destinatario è obbligatorio per la regola"
+    
     is_valid, error, _ = validate_email_list(recipients)
     if not is_valid:
         return False, f"Destinatari regola: {error}"
     
-    if not recipients.strip():
-        return False, "Almeno un destinatario è obbligatorio per la regola"
-    
-    # Logic valido
+    # Logic valido (anche valori JSON non stringa, non hashabili)
     logic = data.get('condition_logic', 'AND')
-    if logic not in ('AND', 'OR'):
+    if not isinstance(logic, str) or logic not in _VALID_LOGIC:
         return False, "Logic deve essere 'AND' o 'OR'"
     
     # Priority numerico
@@ -191,16 +220,46 @@ def validate_routing_rule(data: dict) -> Tuple[bool, str]:
         return False, "Priorità deve essere un numero"
     
     # Condizioni
-    conditions = data.get('conditions', [])
-    for i, cond in enumerate(conditions):
-        if not cond.get('field_name'):
-            return False, f"Condizione {i+1}: campo obbligatorio"
-        if not cond.get('operator'):
-            return False, f"Condizione {i+1}: operatore obbligatorio"
+    is_valid, error = _validate_conditions(data.get('conditions', []))
+    if not is_valid:
+        return False, error
     
     return True, ""
 
 
+def _condition_fields(cond) -> tuple:
+    """
+    (field_name, operator) di una condizione, letti una volta sola.
+    Accetta dict (JSON delle API) o oggetti con attributi (es. RoutingCondition).
+    """
+    if isinstance(cond, dict):
+        get = cond.get
+        return get('field_name'), get('operator')
+    return getattr(cond, 'field_name', None), getattr(cond, 'operator', None)
+
+
+def _validate_conditions(conditions) -> Tuple[bool, str]:
+    """
+    Valida le condizioni di una regola: campo e operatore obbligatori.
+    Il messaggio viene costruito solo per la prima condizione incompleta.
+    
+    Returns:
+        Tuple[bool, str]: (is_valid, error_message)
+    """
+    bad = next(
+        ((i, field) for i, (field, operator) in enumerate(map(_condition_fields, conditions))
+         if not field or not operator),
+        None
+    )
+    if bad is None:
+        return True, ""
+    
+    i, field = bad
+    if not field:
+        return False, f"Condizione {i+1}: campo obbligatorio"
+    return False, f"Condizione {i+1}: operatore obbligatorio"
+
+
 def validate_url(url: str) -> Tuple[bool, str]:
     """
     Valida un URL.
@@ -213,12 +272,13 @@ def validate_url(url: str) -> Tuple[bool, str]:
     
     url = url.strip()
     
-    if not url.startswith(('http://', 'https://')):
-        return False, "URL deve iniziare con http:// o https://"
-    
     if len(url) > 2000:
         return False, "URL troppo lungo (massimo 2000 caratteri)"
     
+    # http:// o https:// (prefisso 'http' in comune)
+    if url[:4] != 'http' or (url[4:7] != '://' and url[4:8] != 's://'):
+        return False, "URL deve iniziare con http:// o https://"
+    
     return True, ""
 
 
@@ -232,14 +292,17 @@ def sanitize_string(value: str, max_length: int = 500) -> str:
     if not value:
         return ""
     
-    # Rimuovi caratteri di controllo
-    value = ''.join(char for char in value if ord(char) >= 32 or char in '\n\r\t')
-    
-    # Tronca se troppo lunga
-    if len(value) > max_length:
-        value = value[:max_length]
-    
-    return value.strip()
+    # Rimuovi caratteri di controllo: per input ASCII (il caso comune)
+    # bytes.translate con tabella di cancellazione, altrimenti str.translate
+    if value.isascii():
+        value = value.encode('ascii').translate(None, _CONTROL_BYTES).decode('ascii')
+    else:
+        value = value.translate(_CONTROL_CHARS)
+    
+    # Spazi esterni e troncamento a max_length (lo slice non copia se la
+    # stringa è già corta; rstrip per non lasciare spazi finali quando il
+    # taglio cade su uno spazio interno)
+    return value.strip()[:max_length].rstrip()
 
 
 class ValidationError(Exception):